@@ -6,7 +6,7 @@ from math import ceil
 from typing import Optional, Union, Iterable
 from uuid import UUID
 
-from flask import Response, abort, redirect, request, flash, url_for, get_template_attribute
+from flask import Response, abort, current_app, redirect, request, flash, url_for, get_template_attribute
 from flask_admin.model.filters import BaseFilter
 from sqlalchemy.orm import joinedload, subqueryload
 from wtforms import RadioField, TextAreaField, Field
@@ -22,7 +22,7 @@ from flask_admin.helpers import get_form_data
 from flask_login import current_user
 from sqlalchemy import nulls_last, func
 from sqlalchemy.sql.functions import coalesce
-from rhinventory.admin_views.asset_files.stream_asset_files_zip import stream_asset_files_zip
+from rhinventory.admin_views.asset_files.stream_asset_files_zip import DEFAULT_READ_SIZE, ZIP_COMPRESSION_MODES, stream_asset_files_zip
 from rhinventory.admin_views.utils import get_asset_list_from_request_args, visible_to_current_user
 
 from rhinventory.extensions import db
@@ -41,6 +41,7 @@ from rhinventory.models.asset import AssetCategory
 from rhinventory.models.asset_attributes import AssetTag, Company
 from rhinventory.models.aggregates.floppy_disk_capture import FloppyDiskCapture
 from rhinventory.events.floppy_disk_captures import FloppyDiskCaptureDisassociated
+from rhinventory.event_store.archive import archive_directory, segments
 from rhinventory.event_store.event_store import event_store
 from rhinventory.util import require_write_access
 
@@ -510,11 +511,15 @@ class AssetView(CustomModelView):
         private_implicit_files = model._query_files.filter(File.privacy == Privacy.private_implicit).count()
 
         related_events = db.session.query(DBEvent).filter(
-            DBEvent.data['name_info']['hh_asset_id'].as_integer() == model.id
+            DBEvent.related_asset_id == model.id
         ).order_by(DBEvent.ingested_at.desc())
 
         latest_events = related_events.limit(20).all()
         related_events_count = related_events.count()
+        # Archived events are only kept for replays, they aren't shown or counted here
+        events_archived_before = None
+        if segments(archive_directory()):
+            events_archived_before = db.session.query(func.min(DBEvent.ingested_at)).scalar()
 
         return self.render(template,
                             model=model,
@@ -529,6 +534,7 @@ class AssetView(CustomModelView):
                             private_implicit_files=private_implicit_files,
                             latest_events=latest_events,
                             related_events_count=related_events_count,
+                            events_archived_before=events_archived_before,
                             properties_by_id=properties_by_id
         )
     
@@ -845,9 +851,17 @@ class AssetView(CustomModelView):
         if not assets:
             abort(404)
 
+        compression = request.args.get('compression', 'auto')
+        if compression not in ZIP_COMPRESSION_MODES:
+            abort(400)
+
         zip_filename = f"asset_files_{datetime.utcnow():%Y-%m-%d}.zip"
         return Response(
-            stream_asset_files_zip(assets),
+            stream_asset_files_zip(
+                [asset.id for asset in assets],
+                read_size=current_app.config.get('ZIP_DOWNLOAD_READ_SIZE', DEFAULT_READ_SIZE),
+                compression=compression,
+            ),
             mimetype='application/zip',
             headers={'Content-Disposition': f'attachment; filename="{zip_filename}"'},
         )
@@ -1,12 +1,49 @@
-from typing import Iterable
+from typing import Iterable, Iterator
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from stat import S_IFREG
 from dataclasses import dataclass
 
+from flask import current_app
+from sqlalchemy import or_
+from sqlalchemy.orm import load_only
 from stream_zip import ZIP_AUTO, stream_zip
 
-from rhinventory.db import Asset, File
+from rhinventory.db import File
+from rhinventory.extensions import db
+from rhinventory.models.file import IMAGE_CATEGORIES
+
+DEFAULT_READ_SIZE = 1024 * 1024
+
+# Files are stat'ed concurrently, which matters a lot on network storage
+STAT_WORKERS = 16
+
+# How many chunks the background reader may get ahead of the zip being sent
+PREFETCH_CHUNKS = 8
+
+# Deflate level 0 writes stored blocks: the data is only checksummed, not compressed.
+# Unlike the zip "store" method it doesn't need the CRC up front, so it still streams.
+STORE_LEVEL = 0
+DEFAULT_DEFLATE_LEVEL = 6
+SMALLEST_DEFLATE_LEVEL = 9
+
+# compression modes accepted by `stream_asset_files_zip`
+ZIP_COMPRESSION_MODES = ('auto', 'fastest', 'smallest')
+
+# Formats that are compressed already, deflating them again gains next to nothing
+COMPRESSED_EXTENSIONS = {
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'avif', 'heic', 'jxl',
+    'zip', '7z', 'rar', 'gz', 'tgz', 'bz2', 'xz', 'zst', 'lzh', 'lha', 'cab',
+    'chd', 'cso', 'dmg',
+    'mp3', 'ogg', 'opus', 'flac', 'm4a', 'mp4', 'm4v', 'mkv', 'webm', 'avi', 'mov',
+    'pdf', 'docx', 'xlsx', 'pptx', 'odt', 'ods', 'epub',
+}
+
+# Images that are stored uncompressed, unlike most in the image categories
+UNCOMPRESSED_IMAGE_EXTENSIONS = {'bmp', 'tif', 'tiff', 'pcx', 'ppm', 'pgm', 'tga'}
 
 @dataclass
 class AssetZipMember:
@@ -14,42 +51,146 @@ class AssetZipMember:
     filepath: str
     size: int
     modified_at: datetime
+    compression_level: int
+
+
+def compression_level_for(file: File, compression: str = 'auto') -> int:
+    """Deflate level for a file, based on its extension and category."""
+    if compression == 'fastest':
+        return STORE_LEVEL
+    if compression == 'smallest':
+        return SMALLEST_DEFLATE_LEVEL
+    extension = file.file_extension.lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return STORE_LEVEL
+    if extension not in UNCOMPRESSED_IMAGE_EXTENSIONS and file.category in IMAGE_CATEGORIES:
+        return STORE_LEVEL
+    # Text, dumps and anything unknown
+    return DEFAULT_DEFLATE_LEVEL
+
+
+def _get_size(filepath: str) -> int | None:
+    try:
+        return os.stat(filepath).st_size
+    except FileNotFoundError:
+        return None
+
 
+_END_OF_FILE = object()
 
-def stream_asset_files_zip(assets: Iterable[Asset]) -> Iterable[bytes]:
+
+class PrefetchingReader:
+    """
+    Reads files one after another on a background thread, so that opening and
+    reading the next member overlaps with compressing and sending the current one.
+    """
+    def __init__(self, filepaths: list[str], read_size: int = DEFAULT_READ_SIZE,
+                 prefetch_chunks: int = PREFETCH_CHUNKS) -> None:
+        self.filepaths = filepaths
+        self.read_size = read_size
+        self._queue: queue.Queue = queue.Queue(maxsize=prefetch_chunks)
+        self._stopped = threading.Event()
+
+    def _put(self, item) -> bool:
+        # Give up once the consumer is gone (e.g. the client disconnected)
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_all(self) -> None:
+        try:
+            for filepath in self.filepaths:
+                with open(filepath, 'rb') as f:
+                    while chunk := f.read(self.read_size):
+                        if not self._put(chunk):
+                            return
+                if not self._put(_END_OF_FILE):
+                    return
+        except Exception as ex:
+            self._put(ex)
+
+    def _file_contents(self) -> Iterator[bytes]:
+        while True:
+            item = self._queue.get()
+            if item is _END_OF_FILE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def __iter__(self) -> Iterator[Iterable[bytes]]:
+        """Yield the contents of every file in order, each must be consumed before the next one."""
+        threading.Thread(target=self._read_all, daemon=True).start()
+        try:
+            for _ in self.filepaths:
+                yield self._file_contents()
+        finally:
+            self._stopped.set()
+
+
+def query_asset_files(asset_ids: Iterable[int]) -> list[File]:
+    """Non-deleted files of the given assets in a single query, ordered by asset id, then by file id."""
+    return db.session.query(File).filter(
+        File.asset_id.in_(list(asset_ids)),
+        or_(File.is_deleted == False, File.is_deleted == None),
+    ).options(
+        load_only(File.id, File.asset_id, File.filepath, File.storage, File.category, File.upload_date)
+    ).order_by(File.asset_id, File.id).all()
+
+
+def stream_asset_files_zip(asset_ids: Iterable[int], read_size: int = DEFAULT_READ_SIZE,
+                           compression: str = 'auto') -> Iterable[bytes]:
+    """
+    :param compression: `auto` only deflates files that are likely to compress,
+        `fastest` deflates nothing and `smallest` deflates everything
+    """
     # Gather all member names and paths up front; file contents are only
     # read lazily while the zip is being streamed out.
+    asset_ids = list(dict.fromkeys(asset_ids))
+    files_by_asset_id: dict[int, list[File]] = {asset_id: [] for asset_id in asset_ids}
+    for file in query_asset_files(asset_ids):
+        assert file.asset_id is not None
+        files_by_asset_id[file.asset_id].append(file)
+    files = [file for asset_id in asset_ids for file in files_by_asset_id[asset_id]]
+
+    # File.full_filepath looks up the store location in the app config for every file
+    store_locations = current_app.config['FILE_STORE_LOCATIONS']
+    filepaths = [os.path.join(store_locations[file.storage.value], file.filepath) for file in files]
+    with ThreadPoolExecutor(max_workers=STAT_WORKERS) as executor:
+        sizes = list(executor.map(_get_size, filepaths))
+
     members: list[AssetZipMember] = []
-    for asset in assets:
-        used_names: set[str] = set()
-        for file in asset.files:
-            assert isinstance(file, File)
-            if file.is_deleted or not os.path.exists(file.full_filepath):
-                continue
-            name = file.filename
-            if name in used_names:
-                if '.' in name:
-                    stem, ext = name.rsplit('.', 1)
-                    name = f"{stem}_{file.id}.{ext}"
-                else:
-                    name = f"{name}_{file.id}"
-            used_names.add(name)
-            members.append(AssetZipMember(
-                zip_name=f"hh{asset.id}/{name}",
-                filepath=file.full_filepath,
-                size=os.path.getsize(file.full_filepath),
-                modified_at=file.upload_date or datetime.now(),
-            ))
+    used_names: dict[int, set[str]] = {}
+    for file, filepath, size in zip(files, filepaths, sizes):
+        if size is None:
+            continue
+        assert file.asset_id is not None
+        asset_used_names = used_names.setdefault(file.asset_id, set())
+        name = file.filename
+        if name in asset_used_names:
+            if '.' in name:
+                stem, ext = name.rsplit('.', 1)
+                name = f"{stem}_{file.id}.{ext}"
+            else:
+                name = f"{name}_{file.id}"
+        asset_used_names.add(name)
+        members.append(AssetZipMember(
+            zip_name=f"hh{file.asset_id}/{name}",
+            filepath=filepath,
+            size=size,
+            modified_at=file.upload_date or datetime.now(),
+            compression_level=compression_level_for(file, compression),
+        ))
 
     mode = S_IFREG | 0o644
 
-    def file_contents(filepath: str) -> Iterable[bytes]:
-        with open(filepath, 'rb') as f:
-            while chunk := f.read(65536):
-                yield chunk
-
     def member_files():
-        for member in members:
-            yield member.zip_name, member.modified_at, mode, ZIP_AUTO(member.size), file_contents(member.filepath)
+        reader = PrefetchingReader([member.filepath for member in members], read_size=read_size)
+        for member, contents in zip(members, reader):
+            yield member.zip_name, member.modified_at, mode, ZIP_AUTO(member.size, level=member.compression_level), contents
 
-    return stream_zip(member_files())
\ No newline at end of file
+    return stream_zip(member_files())
@@ -2,13 +2,12 @@ from io import BufferedReader, FileIO
 import os
 import os.path
 import datetime
-import hashlib
-import multiprocessing as mp
 from pathlib import Path
 import random
-import string
+import secrets
+from dataclasses import dataclass
+from typing import Iterable
 
-import blake3
 from flask import abort, get_template_attribute, request, flash, redirect, url_for, current_app, jsonify
 from flask_login import current_user
 from flask_admin import expose
@@ -18,10 +17,14 @@ from werkzeug.datastructures.file_storage import FileStorage
 from werkzeug.utils import secure_filename
 from rhinventory.admin_views.utils import visible_to_current_user
 
-from rhinventory.datatypes.hashes import BLAKE3Hash, Hashes, MD5Hash, SHA256Hash
+from rhinventory.datatypes.hashes import Hashes
 from rhinventory.db import log, Asset, File, FileCategory, get_next_file_batch_number
 from rhinventory.extensions import db, simple_eval
+from rhinventory.files.hashing import copy_and_hash, hash_file
+from rhinventory.files.images import ImageTask, run_image_tasks
+from rhinventory.files.uploads import HashingUploadStream, upload_directory
 from rhinventory.files.utils import get_dropzone_path, get_dropzone_files
+from rhinventory.jobs import count_pending_jobs, enqueue_file_processing
 from rhinventory.forms import DropzoneFileForm, FileForm, FileAssignForm
 from rhinventory.admin_views.model_view import CustomModelView
 from rhinventory.models.file import FileStore
@@ -37,65 +40,107 @@ class DuplicateFile(RuntimeError):
 
 def calculate_file_hashes(file: BufferedReader | FileStorage) -> Hashes:
     """Calculate MD5, SHA256, and BLAKE3 hashes for a given file-like object."""
-    hash_md5 = hashlib.md5()
-    hash_sha256 = hashlib.sha256()
-    hash_blake3 = blake3.blake3()
-
-    file.seek(0)
-    while chunk := file.read(8192):
-        hash_md5.update(chunk)
-        hash_sha256.update(chunk)
-        hash_blake3.update(chunk)
-    file.seek(0)
-
-    hashes = Hashes(
-        md5=MD5Hash(hash_md5.digest()),
-        sha256=SHA256Hash(hash_sha256.digest()),
-        blake3=BLAKE3Hash(hash_blake3.digest())
-    )
+    hashes, report = hash_file(file)
+    print(f"Hashed {report}")
     return hashes
 
 
-def upload_file(file: FileStorage | Path, category: int | FileCategory=0, batch_number: int | None=None, privacy: int | Privacy=Privacy.private_implicit) -> File:
-    """
-    Handles file upload, check for duplicacy and save the file, but doesn't commit File object data to database.
+@dataclass
+class StagedUpload:
+    """An uploaded file that has been hashed but not yet moved to its final location."""
+    filename: str
+    hashes: Hashes
+    file_store: FileStore
+    # Either a temporary file inside the file store, or a dropzone file that will be moved
+    path: Path
+    is_temporary: bool
 
-    :param file: File handler.
-    :param category: category of file, int from FileCategory
-    :param batch_number:
-    :param privacy: privacy setting, int from Privacy enum, defaults to private_implicit
-    :return: object of type File, not committed to database.
+    def discard(self) -> None:
+        if self.is_temporary and self.path.exists():
+            os.remove(self.path)
+
+
+def stage_upload(file: FileStorage | Path) -> StagedUpload:
+    """
+    Hash an uploaded file.  Uploads from a request have already been streamed into a
+    temporary file in the target store and hashed by werkzeug (see `UploadRequest`),
+    so their data is only written once.
     """
     if isinstance(file, Path):
-        filename = file.name
+        file_store, _ = upload_directory()
+        with open(file, 'rb') as f:
+            hashes = calculate_file_hashes(f)
+
+        return StagedUpload(filename=file.name, hashes=hashes, file_store=file_store, path=file, is_temporary=False)
 
-        size = os.path.getsize(file)
+    filename = file.filename
+    assert filename
 
-        hashes = calculate_file_hashes(open(file, 'rb'))
+    if isinstance(file.stream, HashingUploadStream):
+        hashes, report = file.stream.claim()
+        print(f"Received and hashed {report}")
+        return StagedUpload(filename=filename, hashes=hashes, file_store=file.stream.file_store,
+                            path=file.stream.path, is_temporary=True)
 
-    else:
-        filename = file.filename
-        assert filename
-        size = file.content_length
+    # Not from a request, copy it into the store
+    file_store, directory = upload_directory()
+    temporary_path = Path(f"{directory}/.upload-{secrets.token_hex(8)}.part")
+    with open(temporary_path, 'xb') as temporary_file:
+        try:
+            hashes, report = copy_and_hash(file.stream, temporary_file)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+    print(f"Copied and hashed {report}")
 
-        hashes = calculate_file_hashes(file)
+    return StagedUpload(filename=filename, hashes=hashes, file_store=file_store, path=temporary_path, is_temporary=True)
 
-    matching_file = db.session.query(File).filter(
-            (File.md5 == hashes.md5) | (File.original_md5 == hashes.md5)
-        ).filter(File.is_deleted == False).first()
 
-    if matching_file:
-        raise DuplicateFile("Duplicate file", matching_file)
+def find_duplicate_files(hashes_list: Iterable[Hashes]) -> dict[bytes, File]:
+    """
+    Look up existing, non-deleted files matching any of the given hashes in a single query.
 
-    # Save the file, partially accounting for filename collisions
-    file_store = FileStore(current_app.config['DEFAULT_FILE_STORE'])
-    files_dir = current_app.config['FILE_STORE_LOCATIONS'][file_store.value]
+    :return: dict of matching files keyed by the MD5 of the given hashes.
+    """
+    hashes_list = list(hashes_list)
+    if not hashes_list:
+        return {}
+
+    md5s = [hashes.md5 for hashes in hashes_list]
+    sha256s = [hashes.sha256 for hashes in hashes_list]
+    blake3s = [hashes.blake3 for hashes in hashes_list]
+
+    matching_files = db.session.query(File).filter(
+            File.md5.in_(md5s) | File.original_md5.in_(md5s) |
+            File.sha256.in_(sha256s) | File.blake3.in_(blake3s)
+        ).filter(File.is_deleted == False).order_by(File.id.asc()).all()
+
+    by_hash: dict[bytes, File] = {}
+    for matching_file in matching_files:
+        for hash in (matching_file.md5, matching_file.original_md5, matching_file.sha256, matching_file.blake3):
+            if hash is not None:
+                by_hash.setdefault(hash, matching_file)
+
+    duplicates: dict[bytes, File] = {}
+    for hashes in hashes_list:
+        matching_file = by_hash.get(hashes.md5) or by_hash.get(hashes.sha256) or by_hash.get(hashes.blake3)
+        if matching_file:
+            duplicates[hashes.md5] = matching_file
+    return duplicates
+
+
+def store_upload(staged: StagedUpload, category: int | FileCategory=0, batch_number: int | None=None, privacy: int | Privacy=Privacy.private_implicit) -> File:
+    """
+    Moves a staged upload into the uploads directory and creates its File object, but doesn't commit it to database.
+    """
+    files_dir = current_app.config['FILE_STORE_LOCATIONS'][staged.file_store.value]
     assert isinstance(files_dir, str)
-    filename = secure_filename(filename)
+    directory = 'uploads'
+
+    # Save the file, partially accounting for filename collisions
+    filename = secure_filename(staged.filename)
     if not filename.strip():
         filename = str(datetime.datetime.now().timestamp()) + str(random.randint(0, 1000))
-    directory = 'uploads'
-    os.makedirs(files_dir + "/" + directory, exist_ok=True)
     filepath = f'{directory}/{filename}'
     while os.path.exists(os.path.join(files_dir, filepath)):
         p = filepath.split('.')
@@ -105,11 +150,8 @@ def upload_file(file: FileStorage | Path, category: int | FileCategory=0, batch_
             p[-2] += '_1'
         filepath = '.'.join(p)
 
-    if isinstance(file, FileStorage):
-        file.save(files_dir + "/" + filepath)
-    else:
-        # move the file
-        os.rename(file, files_dir + "/" + filepath)
+    # Temporary files are already in the store, dropzone files are moved
+    os.rename(staged.path, files_dir + "/" + filepath)
     size = os.path.getsize(files_dir + "/" + filepath)
 
     if isinstance(category, int):
@@ -122,12 +164,12 @@ def upload_file(file: FileStorage | Path, category: int | FileCategory=0, batch_
 
     db_file = File()
     db_file.filepath = filepath
-    db_file.storage = file_store
+    db_file.storage = staged.file_store
     db_file.primary = False
     db_file.category = category
-    db_file.md5 = hashes.md5
-    db_file.sha256 = hashes.sha256
-    db_file.blake3 = hashes.blake3
+    db_file.md5 = staged.hashes.md5
+    db_file.sha256 = staged.hashes.sha256
+    db_file.blake3 = staged.hashes.blake3
     if batch_number:
         db_file.batch_number = batch_number
     db_file.upload_date = datetime.datetime.now()
@@ -136,6 +178,57 @@ def upload_file(file: FileStorage | Path, category: int | FileCategory=0, batch_
     db_file.privacy = privacy
     return db_file
 
+
+def upload_files(files: Iterable[FileStorage | Path], category: int | FileCategory=0, batch_number: int | None=None, privacy: int | Privacy=Privacy.private_implicit) -> tuple[list[tuple[str, File]], list[tuple[str, File]]]:
+    """
+    Handles upload of a batch of files with a single duplicate lookup for the whole batch.
+    Files repeated within the batch are also treated as duplicates.  File objects are not committed to database.
+
+    :return: list of (original filename, new File) and list of (original filename, matching File) for skipped duplicates.
+    """
+    staged_uploads: list[StagedUpload] = []
+    try:
+        for file in files:
+            staged_uploads.append(stage_upload(file))
+    except BaseException:
+        for staged in staged_uploads:
+            staged.discard()
+        raise
+
+    duplicates = find_duplicate_files(staged.hashes for staged in staged_uploads)
+
+    db_files: list[tuple[str, File]] = []
+    duplicate_files: list[tuple[str, File]] = []
+    for staged in staged_uploads:
+        matching_file = duplicates.get(staged.hashes.md5)
+        if matching_file:
+            staged.discard()
+            duplicate_files.append((staged.filename, matching_file))
+            continue
+
+        db_file = store_upload(staged, category, batch_number, privacy)
+        duplicates[staged.hashes.md5] = db_file
+        db_files.append((staged.filename, db_file))
+
+    return db_files, duplicate_files
+
+
+def upload_file(file: FileStorage | Path, category: int | FileCategory=0, batch_number: int | None=None, privacy: int | Privacy=Privacy.private_implicit) -> File:
+    """
+    Handles file upload, check for duplicacy and save the file, but doesn't commit File object data to database.
+
+    :param file: File handler.
+    :param category: category of file, int from FileCategory
+    :param batch_number:
+    :param privacy: privacy setting, int from Privacy enum, defaults to private_implicit
+    :return: object of type File, not committed to database.
+    """
+    db_files, duplicate_files = upload_files([file], category, batch_number, privacy)
+    if duplicate_files:
+        raise DuplicateFile("Duplicate file", duplicate_files[0][1])
+    return db_files[0][1]
+
+
 class FileView(CustomModelView):
     can_view_details = True
     list_template = "admin/file/list.html"
@@ -233,65 +326,49 @@ class FileView(CustomModelView):
             file_list: list[FileStorage] = request.files.getlist("files")
             file_list.sort(key=lambda f: f.filename)
 
-            duplicate_files: list[tuple[str | None, File]] = []
-
-            for file in file_list:
-
-                try:
-                    file_db  = upload_file(file, form.category.data, form.batch_number.data, form.privacy.data)
-                except DuplicateFile as e:
-                    duplicate_files.append((file.filename, e.matching_file))
-                    continue
+            uploaded_files, duplicate_files = upload_files(file_list, form.category.data, form.batch_number.data, form.privacy.data)
 
+            for _, file_db in uploaded_files:
                 if file_db.is_image:
                     image_files.append(file_db)
                 
                 files.append(file_db)
 
-            #if current_app.config["MULTIPROCESSING_ENABLED"]:
-            #    pool = mp.Pool(mp.cpu_count(), maxtasksperchild=1)
-            #else:
-            #    pool = None
-            
-            # Temporarily disable multiprocessing due to an issue with references in SQLAlchemy models
-            pool = None
+            read_barcodes = bool(form.auto_assign.data) and not assign_asset
+            background_jobs = current_app.config.get("BACKGROUND_JOBS_ENABLED", False)
+            if background_jobs:
+                # Images get processed by the worker once the files are committed
+                image_files = []
+
+            print("Reading barcodes and creating thumbnails...")
+            # The workers only get paths, SQLAlchemy models can't be sent to other processes.
+            # Results are applied to the File objects here, before they get assigned and renamed.
+            tasks = [ImageTask(
+                path=file.full_filepath,
+                thumbnail_path=file.full_filepath_thumbnail,
+                read_barcode=read_barcodes,
+            ) for file in image_files]
+            results = run_image_tasks(tasks, multiprocessing=current_app.config.get("MULTIPROCESSING_ENABLED", False))
+
+            for file, result in zip(image_files, results):
+                if result.error:
+                    print(f"Failed to process {file.filepath}: {result.error}")
+                if result.thumbnail_created:
+                    file.has_thumbnail = True
 
             if assign_asset:
                 for file in files:
                     file.assign(assign_asset.id)
-            else:
-                print("Reading barcodes...")
-                # Read barcodes in parallel
-                if form.auto_assign.data and image_files:
-                    if pool is not None:
-                        result_objects = [pool.apply_async(File.read_rh_barcode, args=(file,)) for file in image_files]
-                        asset_ids = [r.get() for r in result_objects]
-                    else:
-                        asset_ids = [File.read_rh_barcode(file) for file in image_files]
-                    for file, asset_id in zip(image_files, asset_ids):
-                        if not asset_id:
-                            continue
-                        try:
-                            file.assign(asset_id)
-                        except ValueError:
-                            # Probably failed to assign file to asset because asset doesn't exist
-                            # Ignore this
-                            pass
-
-            print("Creating thumbnails...")
-            # Create thumbnails in parallel
-            if image_files:
-                if pool is not None:
-                    result_objects = [pool.apply_async(File.make_thumbnail, args=(file,)) for file in image_files]
-                    for file, result in zip(image_files, [r.get() for r in result_objects]):
-                        if result:
-                            file.has_thumbnail = True
-                else:
-                    result_objects = [File.make_thumbnail(file) for file in image_files]
-
-            if pool is not None:
-                pool.close()
-                pool.join()
+            elif read_barcodes:
+                for file, result in zip(image_files, results):
+                    if not result.asset_id:
+                        continue
+                    try:
+                        file.assign(result.asset_id)
+                    except ValueError:
+                        # Probably failed to assign file to asset because asset doesn't exist
+                        # Ignore this
+                        pass
 
             print("Committing...")
             db.session.add_all(files)
@@ -299,6 +376,8 @@ class FileView(CustomModelView):
 
             for file in files:
                 log("Create", file, user=current_user)
+            if background_jobs:
+                enqueue_file_processing(files, auto_assign=read_barcodes)
             db.session.commit()
 
             if assign_asset:
@@ -328,15 +407,9 @@ class FileView(CustomModelView):
         dropzone_form = DropzoneFileForm(request.form, batch_number=batch_number)
 
         if request.method == 'POST' and dropzone_form.validate():
-            duplicate_files: list[tuple[str | None, File]] = []
-            for filepath in dropzone_files:
-                try:
-                    file: File = upload_file(file=filepath, batch_number=batch_number, privacy=dropzone_form.privacy.data)
-                except DuplicateFile as e:
-                    duplicate_files.append((filepath.name, e.matching_file))
-                    continue
-
-                asset_id = parse_hh_code(filepath.name.split('.')[0].split('_')[0])
+            uploaded_files, duplicate_files = upload_files(dropzone_files, batch_number=batch_number, privacy=dropzone_form.privacy.data)
+            for filename, file in uploaded_files:
+                asset_id = parse_hh_code(filename.split('.')[0].split('_')[0])
                 if asset_id and dropzone_form.auto_assign.data:
                     try:
                         file.assign(asset_id)
@@ -347,6 +420,10 @@ class FileView(CustomModelView):
 
                 db.session.add(file)
             db.session.commit()
+
+            if current_app.config.get("BACKGROUND_JOBS_ENABLED", False):
+                enqueue_file_processing(file for _, file in uploaded_files)
+                db.session.commit()
             flash(f"{len(dropzone_files)} files processed", 'success')
 
             return redirect(url_for("file.upload_result_view", batch_number=batch_number, 
@@ -394,7 +471,24 @@ class FileView(CustomModelView):
         else:
             duplicate_count = None
         
-        return self.render('admin/file/upload_result.html', files=files, duplicate_files=duplicate_files, auto_assign=auto_assign, batch_number=batch_number, duplicate_count=duplicate_count, order_by=order_by_str)
+        pending_jobs = count_pending_jobs(file.id for file in files)
+
+        return self.render('admin/file/upload_result.html', files=files, duplicate_files=duplicate_files, auto_assign=auto_assign, batch_number=batch_number, duplicate_count=duplicate_count, order_by=order_by_str, pending_jobs=pending_jobs)
+
+    @expose('/upload/jobs', methods=['GET'])
+    @require_write_access
+    def upload_jobs_view(self):
+        """Polled by the upload result page while background jobs for its files are pending."""
+        if 'batch_number' in request.args:
+            file_ids = [file_id for file_id, in db.session.query(File.id).filter(File.batch_number == request.args['batch_number'])]
+        else:
+            file_ids = simple_eval.eval(request.args['files'])
+            assert all(isinstance(file_id, int) for file_id in file_ids)
+
+        pending_jobs = count_pending_jobs(file_ids)
+        if not pending_jobs:
+            return 'OK', 200, {'HX-Refresh': 'true'}
+        return f"Processing files, {pending_jobs} jobs remaining…"
 
 
     @expose('/make_thumbnail/', methods=['POST'])
@@ -439,8 +533,8 @@ class FileView(CustomModelView):
             db.session.commit()
         
             if htmx:
-                rnd = ''.join(random.choice(string.ascii_lowercase) for i in range(10))
-                return get_template_attribute('_macros.html', 'render_file_thumbnail')(model, rnd)
+                # The thumbnail URL carries the new content version, no need to bust caches
+                return get_template_attribute('_macros.html', 'render_file_thumbnail')(model)
 
             flash("Image rotated", 'success')
 
@@ -17,12 +17,15 @@ from rhinventory.extensions import db, admin, github, login_manager
 from rhinventory.admin import CustomIndexView, add_admin_views
 from rhinventory.db import User, Asset, Location, File, log
 from rhinventory.admin_views.utils import visible_to_current_user
+from rhinventory.files.delivery import not_modified, send_stored_file
+from rhinventory.files.thumbnail_cache import get_thumbnail, thumbnail_format, thumbnail_size
+from rhinventory.files.uploads import UploadRequest
 
 from rhinventory.labels.labels import make_barcode, make_label, make_asset_label
 
 from simpleeval import EvalWithCompoundTypes
 from rhinventory.models.entities import Organization
-from rhinventory.models.enums import Privacy
+from rhinventory.models.enums import HIDDEN_PRIVACIES, Privacy
 
 from rhinventory.models.label_printer import LabelPrinter, LabelPrinterMethod
 from rhinventory.models.user import AnynomusUser
@@ -51,6 +54,7 @@ def create_app(config_object='rhinventory.config'):
         print("Not initializing Sentry")
 
     app = Flask(__name__.split('.')[0], template_folder='templates')
+    app.request_class = UploadRequest
     app.config.from_object(config_object)
 
     app.config.SQLALCHEMY_RECORD_QUERIES = True
@@ -358,11 +362,29 @@ Disallow: *
         if not visible_to_current_user(file):
             return abort(403)
 
+        version = file.thumbnail_version if thumb else file.content_version
+        # Versioned URLs are only cached for good while they point to the current content
+        immutable = version is not None and request.args.get('v') == version
+        public = file.privacy not in HIDDEN_PRIVACIES
+
         if thumb:
-            if not file.has_thumbnail:
-                abort(404)
-            return send_file(file.full_filepath_thumbnail)
-        return send_file(file.full_filepath)
+            size = thumbnail_size(request.args.get('size', type=int))
+            accepted_formats = [mimetype.removeprefix('image/') for mimetype, _ in request.accept_mimetypes if mimetype.startswith('image/')]
+            # Thumbnails of one version may be made more than once, so they are only weakly equal
+            etag = f"{version}-{size}.{thumbnail_format(accepted_formats)}" if version else None
+            response = not_modified(etag, weak=True, immutable=immutable, public=public)
+            if response is None:
+                # Generated on first request if it wasn't made at upload time
+                thumbnail = get_thumbnail(file, size, accepted_formats)
+                if thumbnail is None:
+                    abort(404)
+                path, mimetype = thumbnail
+                response = send_stored_file(path, etag, weak=True, immutable=immutable, public=public, mimetype=mimetype)
+            response.vary.add('Accept')
+            return response
+
+        return not_modified(version, immutable=immutable, public=public) or \
+            send_stored_file(file.full_filepath, version, immutable=immutable, public=public)
         
     @app.route('/admin/<path:path>')
     def admin_redirect(path: str):
@@ -26,6 +26,30 @@ assert DEFAULT_FILE_STORE in FILE_STORE_LOCATIONS, f"Invalid DEFAULT_FILE_STORE:
 
 DROPZONE_PATH: str = env.str('DROPZONE_PATH', default='dropzone')
 
+# Thumbnails generated on demand; defaults to .thumbnail_cache in the default file store
+THUMBNAIL_CACHE_DIR: str | None = env.str('THUMBNAIL_CACHE_DIR', default=None)
+THUMBNAIL_CACHE_MAX_SIZE: int = env.int('THUMBNAIL_CACHE_MAX_SIZE', default=2 * 1024 * 1024 * 1024)
+
+# How file contents are sent: flask, x-sendfile or x-accel-redirect (see rhinventory/files/delivery.py)
+FILE_DELIVERY_MODE: str = env.str('FILE_DELIVERY_MODE', default='flask')
+FILE_DELIVERY_ACCEL_PREFIX: str = env.str('FILE_DELIVERY_ACCEL_PREFIX', default='/_files')
+assert FILE_DELIVERY_MODE in ('flask', 'x-sendfile', 'x-accel-redirect'), f"Invalid FILE_DELIVERY_MODE: {FILE_DELIVERY_MODE}"
+
+# Chunk size for reading files into zip downloads; larger is better for network storage
+ZIP_DOWNLOAD_READ_SIZE: int = env.int('ZIP_DOWNLOAD_READ_SIZE', default=1024 * 1024)
+
 MULTIPROCESSING_ENABLED: bool = env.bool("MULTIPROCESSING_ENABLED")
 
+# Hand post-upload processing (thumbnails, barcodes, ...) to `python -m rhinventory.worker`
+BACKGROUND_JOBS_ENABLED: bool = env.bool("BACKGROUND_JOBS_ENABLED", default=False)
+
+# Only store events on ingest and leave the aggregates to `python -m rhinventory.projector`
+AGGREGATE_PROJECTION_ASYNC: bool = env.bool("AGGREGATE_PROJECTION_ASYNC", default=False)
+
+# Where `scripts/archive_events.py` moves cold events to, they are still replayed from there
+EVENT_ARCHIVE_DIR: str | None = env.str('EVENT_ARCHIVE_DIR', default=None)
+
+# Write the audit log of a transaction in one go when it commits, instead of on every flush
+AUDIT_LOG_DEFERRED: bool = env.bool("AUDIT_LOG_DEFERRED", default=False)
+
 SENTRY_DSN = env.str('SENTRY_DSN', None)
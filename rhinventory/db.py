@@ -12,9 +12,10 @@ from rhinventory.models.asset import Asset, AssetStatus, AssetMeta, Medium
 from rhinventory.models.transaction import TransactionType, Transaction
 from rhinventory.models.file import FileCategory, File, IMAGE_CATEGORIES, get_next_file_batch_number
 from rhinventory.models.log import log, LogEvent, LogItem
+from rhinventory.models.job import Job, JobType, JobStatus
 from rhinventory.models.entities import Organization, Party, Country
 from rhinventory.models.magdb import Issuer, Magazine, MagazineIssue, Format, MagazineIssueVersion, MagazineIssueVersionPrice
-from rhinventory.models.events import DBEvent, EventSession, PushKey
+from rhinventory.models.events import AggregateCheckpoint, DBEvent, EventSession, PushKey
 from rhinventory.models.aggregates.test import TestAggregate
 from rhinventory.models.aggregates.floppy_disk_capture import FloppyDiskCapture, AssetIdSource
 from rhinventory.models.aggregates.file import FileAggregate
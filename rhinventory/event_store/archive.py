@@ -0,0 +1,117 @@
+"""
+Archive of cold events in compressed segment files.
+
+Events that every aggregate has applied can be moved out of the `events` table
+(see `EventStore.archive_events`) into segments of consecutive positions, each a
+gzipped MessagePack array.  The event payload is kept as the stored JSON, so it
+is decoded exactly like events read from the database.
+
+Replays read the segments first and the table after them.  Archiving always
+moves the oldest events, so the table starts where the archive ends.
+"""
+import gzip
+import os
+import re
+import secrets
+from datetime import datetime
+from typing import Iterable, Iterator
+from uuid import UUID
+
+import msgspec
+from flask import current_app
+
+# Events per segment file
+ARCHIVE_SEGMENT_SIZE = 10000
+
+_SEGMENT_FILENAME_RE = re.compile(r'^events_(\d+)_(\d+)\.msgpack\.gz$')
+
+
+class ArchivedEvent(msgspec.Struct, array_like=True):
+    id: UUID
+    position: int
+    namespace: str
+    class_name: str
+    timestamp: datetime
+    ingested_at: datetime
+    event_session_id: int
+    related_asset_id: int | None
+    # The event as stored, JSON
+    data: bytes
+
+
+_encoder = msgspec.msgpack.Encoder()
+_decoder = msgspec.msgpack.Decoder(list[ArchivedEvent])
+
+
+def archive_directory() -> str | None:
+    """The archive directory, or None if archiving is disabled."""
+    return current_app.config.get('EVENT_ARCHIVE_DIR')
+
+
+def segment_filename(first_position: int, last_position: int) -> str:
+    return f"events_{first_position:012d}_{last_position:012d}.msgpack.gz"
+
+
+def segments(directory: str | None) -> list[tuple[int, int, str]]:
+    """(first position, last position, path) of every segment, in order."""
+    if directory is None or not os.path.isdir(directory):
+        return []
+    found = []
+    for filename in os.listdir(directory):
+        match = _SEGMENT_FILENAME_RE.match(filename)
+        if match:
+            found.append((int(match[1]), int(match[2]), os.path.join(directory, filename)))
+    return sorted(found)
+
+
+def read_segment(path: str) -> list[ArchivedEvent]:
+    with open(path, 'rb') as f:
+        return _decoder.decode(gzip.decompress(f.read()))
+
+
+def write_segment(directory: str, events: list[ArchivedEvent]) -> str:
+    """Write a segment atomically, the events must be in position order."""
+    assert events
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, segment_filename(events[0].position, events[-1].position))
+    temporary_path = f"{path}.{secrets.token_hex(4)}.part"
+    try:
+        with open(temporary_path, 'xb') as f:
+            f.write(gzip.compress(_encoder.encode(events)))
+            # The events are deleted from the database right after
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return path
+
+
+def iter_archived_events(
+        directory: str | None,
+        class_names: Iterable[str],
+        after_position: int = 0,
+        before_position: int | None = None) -> Iterator[ArchivedEvent]:
+    """
+    Archived events of the given classes with positions in (after_position, before_position),
+    in position order.
+
+    :param before_position: the first position still in the table; events that are in both
+        (archiving was interrupted before they were deleted) are read from the table
+    """
+    class_names = set(class_names)
+    # Segments may overlap if archiving was interrupted and ran again with more events
+    for first_position, last_position, path in segments(directory):
+        if last_position <= after_position:
+            continue
+        if before_position is not None and first_position >= before_position:
+            break
+        for event in read_segment(path):
+            if event.position <= after_position:
+                continue
+            if before_position is not None and event.position >= before_position:
+                return
+            after_position = event.position
+            if event.class_name in class_names:
+                yield event
@@ -1,18 +1,26 @@
 from contextlib import contextmanager
+import itertools
+from datetime import timedelta
 from enum import Enum
-import json
-from typing import Iterable, Iterator
+from typing import Any, Collection, Iterable, Iterator, Sequence
+from uuid import UUID
 import msgspec
+from sqlalchemy import Text, bindparam, cast, delete, exists, func, insert, inspect, select
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import event as sa_event
+from sqlalchemy.orm import Session, SessionTransaction
 from tqdm import tqdm
 
+from flask import current_app
 from flask_login import current_user
 
 from hhfloppy.event.events import HHFLOPPY_EVENT_CLASS_UNION, event_decoder as hhfloppy_event_decoder, EVENT_VERSION as HHFLOPPY_EVENT_VERSION
 
 from rhinventory.db import db
+from rhinventory.event_store.archive import ARCHIVE_SEGMENT_SIZE, ArchivedEvent, archive_directory, iter_archived_events, write_segment
 from rhinventory.events.events import RHINVENTORY_EVENT_CLASS_UNION, event_decoder as rhinventory_event_decoder
-from rhinventory.models.aggregates.aggregate import Aggregate, registered_aggregate_classes
-from rhinventory.models.events import DBEvent, EventSession, datetime
+from rhinventory.models.aggregates.aggregate import Aggregate, aggregate_classes_by_event_class, registered_aggregate_classes
+from rhinventory.models.events import AggregateCheckpoint, DBEvent, EventSession, datetime
 
 class EventNamespaceName(Enum):
     RHINVENTORY = "rhinventory"
@@ -26,12 +34,93 @@ supported_event_version = HHFLOPPY_EVENT_VERSION
 class UnsupportedEventVersion(Exception):
     pass
 
+# Events fetched per round trip when replaying
+REBUILD_BATCH_SIZE = 1000
+# Events applied per transaction when catching up
+CATCH_UP_BATCH_SIZE = 1000
+
+# Held while appending events and while finishing a catch-up or rebuild.  Appends
+# are serialized by it, so events become visible in the order of their positions
+# and a checkpoint never skips an event that is committed later.
+EVENT_APPEND_LOCK_ID = 0x72686976
+
+# Notified on every ingest in the async projection mode, see rhinventory/projector.py
+EVENTS_NOTIFY_CHANNEL = 'rhinventory_events'
+
+def _lock_event_append() -> None:
+    """Take the append lock until the end of the transaction."""
+    db.session.execute(select(func.pg_advisory_xact_lock(EVENT_APPEND_LOCK_ID)))
+
+def _last_event_position() -> int:
+    # The newest event is never archived, so this holds with an archive too
+    return db.session.scalar(select(func.coalesce(func.max(DBEvent.position), 0)))
+
+def _first_event_position() -> int | None:
+    """Position of the oldest event in the table, the ones before it are archived."""
+    return db.session.scalar(select(func.min(DBEvent.position)))
+
+def related_asset_id(event: EVENT_CLASS_UNION) -> int | None:
+    """The asset an event names, if any (e.g. the asset ID in the filename of a floppy disk capture)."""
+    name_info = getattr(event, 'name_info', None)
+    return getattr(name_info, 'hh_asset_id', None) or None
+
+def _event_class_names(aggregate_classes: Iterable[type[Aggregate]]) -> set[str]:
+    return {event_class.__name__
+            for aggregate_class in aggregate_classes
+            for event_class in aggregate_class.listen_for_event_classes}
+
+def _get_checkpoints(aggregate_classes: Iterable[type[Aggregate]]) -> dict[type[Aggregate], AggregateCheckpoint]:
+    """Checkpoints of the given aggregate classes, created for the ones that don't have any yet."""
+    aggregate_classes = list(aggregate_classes)
+    existing = {
+        checkpoint.aggregate_table: checkpoint
+        for checkpoint in db.session.query(AggregateCheckpoint).filter(
+            AggregateCheckpoint.aggregate_table.in_([cls.__tablename__ for cls in aggregate_classes])
+        )
+    }
+    checkpoints: dict[type[Aggregate], AggregateCheckpoint] = {}
+    for aggregate_class in aggregate_classes:
+        checkpoint = existing.get(aggregate_class.__tablename__)
+        if checkpoint is None:
+            # A new aggregate only has to catch up if events it listens for have been stored before
+            has_history = db.session.scalar(select(exists().where(
+                DBEvent.class_name.in_(_event_class_names([aggregate_class]))
+            )))
+            checkpoint = AggregateCheckpoint(
+                aggregate_table=aggregate_class.__tablename__,
+                position=0 if has_history else _last_event_position(),
+            )
+            db.session.add(checkpoint)
+        checkpoints[aggregate_class] = checkpoint
+    return checkpoints
+
+_PENDING_AGGREGATES_KEY = 'rhinventory_pending_aggregates'
+
+def _pending_aggregates(session: Session) -> dict[tuple[type[Aggregate], UUID], Aggregate]:
+    """Aggregates created in the current transaction, by identity."""
+    return session.info.setdefault(_PENDING_AGGREGATES_KEY, {})
+
+@sa_event.listens_for(db.session, 'after_transaction_end')
+def _forget_pending_aggregates(session: Session, transaction: SessionTransaction) -> None:
+    # By now they have either been flushed, and session.get finds them, or rolled back
+    session.info.pop(_PENDING_AGGREGATES_KEY, None)
+
+def _column_values(instance: Aggregate) -> dict[str, Any]:
+    """Column attributes that have been set on an instance, so that unset ones get their defaults."""
+    state = inspect(instance)
+    return {attr.key: state.dict[attr.key] for attr in state.mapper.column_attrs if attr.key in state.dict}
+
+# The serialized event goes into the JSONB column as it is, without a round trip through a dict
+_insert_db_event = insert(DBEvent.__table__).values(
+    data=cast(bindparam('serialized_event', type_=Text), JSONB)
+)
+
 class EventStore():
     def __init__(self) -> None:
         pass
 
     @staticmethod
-    def decode(event_data: bytes | dict, namespace: EventNamespaceName) -> EVENT_CLASS_UNION:
+    def decode(event_data: bytes | str | msgspec.Raw | dict, namespace: EventNamespaceName) -> EVENT_CLASS_UNION:
         if isinstance(event_data, dict):
             event_data = msgspec.json.encode(event_data)
         
@@ -48,57 +137,281 @@ class EventStore():
                 case _:
                     raise ValueError(f"Unsupported namespace: {namespace}")
         except msgspec.DecodeError as e:
-            raise ValueError(f"Failed to decode event for namespace {namespace}: {e}\nFull event data: {event_data.decode('utf-8')}") from e
+            if not isinstance(event_data, str):
+                event_data = bytes(event_data).decode('utf-8')
+            raise ValueError(f"Failed to decode event for namespace {namespace}: {e}\nFull event data: {event_data}") from e
     
-    def _apply_event_to_aggregates(self, event: EVENT_CLASS_UNION, aggregate_classes: list[type[Aggregate]]) -> None:
-        for aggregate_class in registered_aggregate_classes:
-            if type(event) in aggregate_class.listen_for_event_classes:
-                filter_expr = aggregate_class.filter_from_event(event)
-                if isinstance(filter_expr, bool) and filter_expr is False:
-                    continue
+    def _find_aggregate(self, aggregate_class: type[Aggregate], event: EVENT_CLASS_UNION) -> tuple[UUID | None, Aggregate | None] | None:
+        """
+        Find the aggregate instance an event applies to.
 
-                q = db.session.query(aggregate_class)
-                if filter_expr is not True:
-                    q = q.filter(filter_expr)
+        :return: the identity of the aggregate and the instance (None if it doesn't exist yet),
+            or None if the event doesn't apply to any instance
+        """
+        identity = aggregate_class.identity_from_event(event)
+        if identity is not None:
+            # Aggregates created earlier in this transaction aren't flushed yet, so session.get can't see them
+            aggregate_instance = _pending_aggregates(db.session).get((aggregate_class, identity))
+            if aggregate_instance is None:
+                aggregate_instance = db.session.get(aggregate_class, identity)
+            return identity, aggregate_instance
 
-                aggregate_instance = q.one_or_none()
+        filter_expr = aggregate_class.filter_from_event(event)
+        if isinstance(filter_expr, bool) and filter_expr is False:
+            return None
 
-                if aggregate_instance is None:
-                    aggregate_instance = aggregate_class()
-                    aggregate_instance.apply_event(event)
-                    db.session.add(aggregate_instance)
-                else:
-                    aggregate_instance.apply_event(event)
+        q = db.session.query(aggregate_class)
+        if filter_expr is not True:
+            q = q.filter(filter_expr)
+
+        return None, q.one_or_none()
+
+    def _apply_event_to_aggregates(self, event: EVENT_CLASS_UNION, aggregate_classes: Collection[type[Aggregate]] | None = None) -> None:
+        """Apply an event to the aggregates listening for it, limited to `aggregate_classes` if given."""
+        for aggregate_class in aggregate_classes_by_event_class.get(type(event), ()):
+            if aggregate_classes is not None and aggregate_class not in aggregate_classes:
+                continue
+
+            found = self._find_aggregate(aggregate_class, event)
+            if found is None:
+                continue
+            identity, aggregate_instance = found
+
+            if aggregate_instance is None:
+                aggregate_instance = aggregate_class()
+                aggregate_instance.apply_event(event)
+                db.session.add(aggregate_instance)
+                if identity is not None:
+                    _pending_aggregates(db.session)[(aggregate_class, identity)] = aggregate_instance
+            else:
+                aggregate_instance.apply_event(event)
 
     def rebuild_aggregates(
             self,
             aggregate_classes: Iterable[type[Aggregate]] | None = None,
             show_progress: bool = False) -> None:
+        """
+        Rebuild aggregates from scratch by replaying their events.
+
+        Events are streamed in batches and decoded straight from the stored JSON,
+        aggregates are folded in memory keyed by their identity and written back
+        with bulk inserts, all in a single transaction.
+        """
         if aggregate_classes is None:
             aggregate_classes = registered_aggregate_classes
+        aggregate_classes = list(aggregate_classes)
+
+        # Events can't be ingested meanwhile, they would be lost with the old aggregates
+        _lock_event_append()
+        last_position = _last_event_position()
+        class_names = _event_class_names(aggregate_classes)
+
+        archived_rows = (
+            (archived_event.namespace, archived_event.data)
+            for archived_event in iter_archived_events(archive_directory(), class_names,
+                                                       before_position=_first_event_position())
+        )
+        stored_rows = db.session.execute(
+            select(DBEvent.namespace, cast(DBEvent.data, Text))
+            .where(DBEvent.class_name.in_(class_names))
+            .order_by(DBEvent.position.asc())
+            .execution_options(yield_per=REBUILD_BATCH_SIZE)
+        ).tuples()
+        rows: Iterable[tuple[str, str | bytes]] = itertools.chain(archived_rows, stored_rows)
+
+        if show_progress:
+            rows = tqdm(rows, desc="Rebuilding aggregates", unit=" events")
+
+        rebuilt_classes = set(aggregate_classes)
+        aggregates: dict[tuple[type[Aggregate], UUID | None], Aggregate] = {}
+        for namespace, event_data in rows:
+            event = self.decode(event_data=event_data, namespace=EventNamespaceName(namespace))
+            for aggregate_class in aggregate_classes_by_event_class.get(type(event), ()):
+                if aggregate_class not in rebuilt_classes:
+                    continue
+
+                identity = aggregate_class.identity_from_event(event)
+                if identity is None:
+                    filter_expr = aggregate_class.filter_from_event(event)
+                    if isinstance(filter_expr, bool) and filter_expr is False:
+                        continue
+                    if filter_expr is not True:
+                        raise ValueError(f"{aggregate_class.__name__} can only be rebuilt if it implements identity_from_event")
+
+                aggregate_instance = aggregates.get((aggregate_class, identity))
+                if aggregate_instance is None:
+                    aggregate_instance = aggregate_class()
+                    aggregates[(aggregate_class, identity)] = aggregate_instance
+                aggregate_instance.apply_event(event)
+
         for aggregate_class in aggregate_classes:
             db.session.query(aggregate_class).delete()
+            values = [_column_values(aggregate_instance)
+                      for (cls, _), aggregate_instance in aggregates.items() if cls is aggregate_class]
+            if values:
+                db.session.execute(insert(aggregate_class), values)
+        for checkpoint in _get_checkpoints(aggregate_classes).values():
+            checkpoint.position = last_position
+        db.session.commit()
+
+    def catch_up(
+            self,
+            aggregate_classes: Iterable[type[Aggregate]] | None = None,
+            show_progress: bool = False) -> int:
+        """
+        Apply the events stored after their checkpoints to aggregates that have
+        fallen behind, e.g. ones added after events they listen for were stored.
+
+        Events are applied in batches, each committed together with the checkpoints.
+        The last batch is applied holding the append lock, so that ingestion carries
+        on right after it.
 
-            class_names = [cls.__name__ for cls in aggregate_class.listen_for_event_classes]
-
-            q = db.session.query(DBEvent) \
-                .filter(DBEvent.class_name.in_(class_names)) \
-                .order_by(DBEvent.ingested_at.asc())
-            
-            if show_progress:
-                q = tqdm(q, desc=f"Rebuilding {aggregate_class.__name__}")
-            
-            for db_event in q:
-                event_data = msgspec.json.decode(json.dumps(db_event.data))
-                event = self.decode(
-                    event_data=msgspec.json.encode(event_data),
-                    namespace=EventNamespaceName(db_event.namespace)
+        :return: the number of events applied
+        """
+        if aggregate_classes is None:
+            aggregate_classes = registered_aggregate_classes
+        aggregate_classes = list(aggregate_classes)
+        class_names = _event_class_names(aggregate_classes)
+
+        progress = tqdm(desc="Catching up", unit=" events") if show_progress else None
+        applied = 0
+        locked = False
+        while True:
+            checkpoints = _get_checkpoints(aggregate_classes)
+            start = min((checkpoint.position for checkpoint in checkpoints.values()), default=0)
+            rows: list[tuple[int, str, str | bytes]] = [
+                (archived_event.position, archived_event.namespace, archived_event.data)
+                for archived_event in itertools.islice(
+                    iter_archived_events(archive_directory(), class_names,
+                                         after_position=start, before_position=_first_event_position()),
+                    CATCH_UP_BATCH_SIZE,
                 )
+            ]
+            if rows:
+                # The events in the table come after these
+                last_batch = False
+            else:
+                rows = list(db.session.execute(
+                    select(DBEvent.position, DBEvent.namespace, cast(DBEvent.data, Text))
+                    .where(DBEvent.position > start, DBEvent.class_name.in_(class_names))
+                    .order_by(DBEvent.position.asc())
+                    .limit(CATCH_UP_BATCH_SIZE)
+                ).tuples())
+                last_batch = len(rows) < CATCH_UP_BATCH_SIZE
+            if last_batch and not locked:
+                _lock_event_append()
+                locked = True
+                continue
+
+            for position, namespace, event_data in rows:
+                event = self.decode(event_data=event_data, namespace=EventNamespaceName(namespace))
+                behind = {aggregate_class for aggregate_class, checkpoint in checkpoints.items()
+                          if checkpoint.position < position}
+                self._apply_event_to_aggregates(event=event, aggregate_classes=behind)
+            applied += len(rows)
+            if progress is not None:
+                progress.update(len(rows))
 
-                self._apply_event_to_aggregates(event=event, aggregate_classes=[aggregate_class])
+            # With the lock held, nothing can have been stored after the last event
+            end = _last_event_position() if last_batch else rows[-1][0]
+            for checkpoint in checkpoints.values():
+                checkpoint.position = max(checkpoint.position, end)
             db.session.commit()
+            locked = False
 
-    def ingest(self, event: EVENT_CLASS_UNION, event_session: EventSession) -> None:
+            if last_batch:
+                break
+
+        if progress is not None:
+            progress.close()
+        return applied
+
+    def archive_events(self, older_than: datetime, show_progress: bool = False) -> int:
+        """
+        Move events stored before `older_than` out of the table into archive segments
+        (see rhinventory/event_store/archive.py).  Only events that every aggregate
+        has applied are archived.  Archived events are still replayed, but nothing
+        else reads them (e.g. the related events on asset pages).
+
+        :return: the number of events archived
+        """
+        directory = archive_directory()
+        if directory is None:
+            raise ValueError("EVENT_ARCHIVE_DIR is not set")
+
+        progress = tqdm(desc="Archiving events", unit=" events") if show_progress else None
+        archived = 0
+        while True:
+            # Keeps rebuilds from reading the events while they are being moved
+            _lock_event_append()
+            checkpoints = _get_checkpoints(registered_aggregate_classes)
+            cold_position = db.session.scalar(
+                select(func.max(DBEvent.position)).where(DBEvent.ingested_at < older_than)
+            ) or 0
+            # The newest event stays, positions carry on from it
+            limit_position = min([cold_position, _last_event_position() - 1]
+                                 + [checkpoint.position for checkpoint in checkpoints.values()])
+
+            # Always a prefix of the positions, the table has to start where the archive ends
+            rows = db.session.execute(
+                select(DBEvent.id, DBEvent.position, DBEvent.namespace, DBEvent.class_name,
+                       DBEvent.timestamp, DBEvent.ingested_at, DBEvent.event_session_id,
+                       DBEvent.related_asset_id, cast(DBEvent.data, Text))
+                .where(DBEvent.position <= limit_position)
+                .order_by(DBEvent.position.asc())
+                .limit(ARCHIVE_SEGMENT_SIZE)
+            ).tuples().all()
+            if not rows:
+                db.session.commit()
+                break
+
+            events = [
+                ArchivedEvent(
+                    id=id, position=position, namespace=namespace, class_name=class_name,
+                    timestamp=timestamp, ingested_at=ingested_at, event_session_id=event_session_id,
+                    related_asset_id=related_asset_id, data=data.encode('utf-8'),
+                )
+                for id, position, namespace, class_name, timestamp, ingested_at, event_session_id, related_asset_id, data
+                in rows
+            ]
+            write_segment(directory, events)
+            db.session.execute(delete(DBEvent).where(DBEvent.position <= events[-1].position))
+            db.session.commit()
+
+            archived += len(events)
+            if progress is not None:
+                progress.update(len(events))
+
+        if progress is not None:
+            progress.close()
+        return archived
+
+    def projection_lag(self) -> dict[str, dict[str, int | float]]:
+        """
+        How far behind the stored events every aggregate table is: in event positions
+        and in seconds since the oldest event that hasn't been applied to it was stored.
+        """
+        last_position = _last_event_position()
+        checkpoint_positions = dict(db.session.execute(
+            select(AggregateCheckpoint.aggregate_table, AggregateCheckpoint.position)
+        ).tuples().all())
+        now = datetime.now()
+        lag: dict[str, dict[str, int | float]] = {}
+        for aggregate_class in registered_aggregate_classes:
+            position = checkpoint_positions.get(aggregate_class.__tablename__, 0)
+            oldest_pending = db.session.scalar(
+                select(func.min(DBEvent.ingested_at))
+                .where(DBEvent.position > position,
+                       DBEvent.class_name.in_(_event_class_names([aggregate_class])))
+            )
+            lag[aggregate_class.__tablename__] = {
+                'checkpoint': position,
+                'positions_behind': last_position - position,
+                'seconds_behind': (now - oldest_pending).total_seconds() if oldest_pending else 0.0,
+            }
+        return lag
+
+    def _check_event(self, event: EVENT_CLASS_UNION, event_session: EventSession) -> None:
         if event.event_namespace != event_session.namespace:
             raise ValueError(
                 f"Event namespace '{event.event_namespace}' does not match "
@@ -109,22 +422,77 @@ class EventStore():
                 f"Unsupported event version: {event.event_version}. "
             )
 
-        db_event = DBEvent()
-        # Note: We are trusting the event ID from the client here.
-        db_event.id = event.event_id
-        db_event.namespace = event.event_namespace
-        db_event.class_name = event.__class__.__name__
-        db_event.timestamp = event.event_timestamp
-        db_event.ingested_at = datetime.now()
-        db_event.event_session_id = event_session.id
-        # XXX Here we are doing a encode-decode round-trip because we need the format
-        # encoded by msgspec but SQLAlchemy needs a dict 
-        db_event.data = json.loads(msgspec.json.encode(event))
-        db.session.add(instance=db_event)
-
-        self._apply_event_to_aggregates(event=event, aggregate_classes=registered_aggregate_classes)
+    def ingest(self, event: EVENT_CLASS_UNION, event_session: EventSession) -> None:
+        self.ingest_batch(events=[event], event_session=event_session)
 
-        db.session.commit()
+    def ingest_batch(
+            self,
+            events: Sequence[EVENT_CLASS_UNION],
+            event_session: EventSession,
+            serialized_events: Sequence[bytes | msgspec.Raw] | None = None) -> None:
+        """
+        Store events and apply them to the aggregates in a single transaction.
+        With `AGGREGATE_PROJECTION_ASYNC`, the events are only stored and the
+        aggregates are left to the projector.
+
+        Either all events are ingested or, if any of them is invalid or already
+        stored, none of them are (and the transaction is rolled back).
+
+        :param serialized_events: the JSON the events were decoded from, stored as is
+            instead of encoding the events again
+        """
+        for event in events:
+            self._check_event(event, event_session)
+        if serialized_events is None:
+            serialized_events = [msgspec.json.encode(event) for event in events]
+        assert len(serialized_events) == len(events)
+
+        ingested_at = datetime.now()
+        try:
+            _lock_event_append()
+            project_async = current_app.config.get('AGGREGATE_PROJECTION_ASYNC', False)
+            if project_async:
+                # The projector applies them once the events are committed
+                checkpoints: dict[type[Aggregate], AggregateCheckpoint] = {}
+                db.session.execute(select(func.pg_notify(EVENTS_NOTIFY_CHANNEL, '')))
+            else:
+                previous_position = _last_event_position()
+                # Aggregates that are behind are left to `catch_up`, applying events out of order would corrupt them
+                checkpoints = {
+                    aggregate_class: checkpoint
+                    for aggregate_class, checkpoint in _get_checkpoints(registered_aggregate_classes).items()
+                    if checkpoint.position >= previous_position
+                }
+
+            if events:
+                db.session.execute(_insert_db_event, [
+                    {
+                        # Note: We are trusting the event ID from the client here.
+                        'id': event.event_id,
+                        'namespace': event.event_namespace,
+                        'class_name': event.__class__.__name__,
+                        'timestamp': event.event_timestamp,
+                        # Keep ingested_at distinct and in order within the batch, like separate ingests would be
+                        'ingested_at': ingested_at + timedelta(microseconds=i),
+                        'event_session_id': event_session.id,
+                        'related_asset_id': related_asset_id(event),
+                        'serialized_event': bytes(serialized_event).decode('utf-8'),
+                    }
+                    for i, (event, serialized_event) in enumerate(zip(events, serialized_events))
+                ])
+
+            for event in events:
+                self._apply_event_to_aggregates(event=event, aggregate_classes=checkpoints.keys())
+
+            if checkpoints:
+                last_position = _last_event_position()
+                for checkpoint in checkpoints.values():
+                    checkpoint.position = last_position
+
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
 
     @contextmanager
     def event_session_for_current_user(
@@ -1,6 +1,6 @@
 from datetime import datetime, timedelta
 
-from flask import Blueprint, flash, redirect, render_template, request, url_for
+from flask import Blueprint, current_app, flash, redirect, render_template, request, url_for
 from flask_login import current_user
 import msgspec
 
@@ -96,12 +96,35 @@ def check_key():
         return {"authorized": True}, 200
 
 
+@event_store_bp.route("/projection_lag/", methods=["GET"])
+def projection_lag():
+    """How far behind the events the aggregates are, per aggregate table, for monitoring."""
+    if not (current_user.is_authenticated and current_user.admin):
+        return {"error": "Forbidden"}, 403
+
+    return {
+        "async": current_app.config.get('AGGREGATE_PROJECTION_ASYNC', False),
+        "aggregates": event_store.projection_lag(),
+    }
+
+
+class IngestRequest(msgspec.Struct):
+    namespace: str
+    key: str
+    # Left undecoded, every event is decoded with the decoder of its namespace
+    serialized_events: list[msgspec.Raw]
+
+ingest_request_decoder = msgspec.json.Decoder(IngestRequest)
+
+
 @event_store_bp.route("/ingest/", methods=["POST"])
 def ingest_event():
-    if not request.json:
+    try:
+        ingest_request = ingest_request_decoder.decode(request.get_data())
+    except msgspec.DecodeError:
         return {"error": "Invalid JSON"}, 400
-    namespace = request.json['namespace']
-    key = request.json['key']
+    namespace = ingest_request.namespace
+    key = ingest_request.key
 
     event_session = db.session.query(EventSession).filter(
         EventSession.namespace==namespace,
@@ -124,18 +147,20 @@ def ingest_event():
 
     namespace = EventNamespaceName(namespace)
 
-    events = request.json['serialized_events']
-    for event_data in events:
-        event = event_store.decode(event_data=msgspec.json.encode(event_data), namespace=namespace)
-
-        try:
-            event_store.ingest(
-                event=event,
-                event_session=event_session
-            )
-        except UnsupportedEventVersion as e:
-            return {"error": str(e)}, 400
-
-    db.session.commit()
+    serialized_events = ingest_request.serialized_events
+    events = [
+        event_store.decode(event_data=serialized_event, namespace=namespace)
+        for serialized_event in serialized_events
+    ]
+
+    # Commits the push key use together with the events
+    try:
+        event_store.ingest_batch(
+            events=events,
+            event_session=event_session,
+            serialized_events=serialized_events,
+        )
+    except UnsupportedEventVersion as e:
+        return {"error": str(e)}, 400
 
     return {"status": "success"}
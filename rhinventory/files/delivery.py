@@ -0,0 +1,125 @@
+"""
+Sending stored files (originals and thumbnails) to clients.
+
+Responses carry ETags derived from the stored content hashes, so revalidation is
+answered with 304 before the file is even looked at.  URLs that carry the current
+content version (`?v=`, see `File.url`) are cached by browsers for good, but the
+privacy of a file can change under the same URL: shared caches revalidate public
+files after `SHARED_MAX_AGE` and hidden files are never kept for long.
+
+The transfer itself is done according to `FILE_DELIVERY_MODE`:
+
+- `flask`: streamed by the worker, Range requests are supported
+- `x-sendfile`: handed to the front server with an `X-Sendfile` header (Apache, lighttpd)
+- `x-accel-redirect`: handed to nginx with an `X-Accel-Redirect` header, file stores
+  are expected at internal locations `{FILE_DELIVERY_ACCEL_PREFIX}/{file store name}/`
+  and a separate thumbnail cache directory at `{FILE_DELIVERY_ACCEL_PREFIX}/thumbnail_cache/`
+"""
+import mimetypes
+import os
+import urllib.parse
+
+from flask import current_app, request
+from werkzeug.utils import send_file
+from werkzeug.wrappers.response import Response
+
+from rhinventory.files.thumbnail_cache import get_thumbnail_cache
+
+FILE_DELIVERY_MODES = ('flask', 'x-sendfile', 'x-accel-redirect')
+
+# Versioned URLs never change content
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# How long shared caches may serve a public file without asking, it may have been hidden since
+SHARED_MAX_AGE = 10 * 60
+
+# How long clients may keep a hidden file under a versioned URL without asking
+PRIVATE_MAX_AGE = 5 * 60
+
+
+def _accel_redirect_roots() -> list[tuple[str, str]]:
+    """(directory, internal location) pairs, in order of precedence."""
+    prefix = current_app.config.get('FILE_DELIVERY_ACCEL_PREFIX', '/_files').rstrip('/')
+    roots = [(location, f"{prefix}/{name}")
+             for name, location in current_app.config['FILE_STORE_LOCATIONS'].items() if location]
+    # By default the cache is inside the default file store and served from there
+    roots.append((get_thumbnail_cache().directory, f"{prefix}/thumbnail_cache"))
+    return roots
+
+
+def accel_redirect_uri(path: str) -> str | None:
+    """The internal nginx location of a file, or None if it isn't in a known directory."""
+    path = os.path.abspath(path)
+    for directory, location in _accel_redirect_roots():
+        directory = os.path.abspath(directory)
+        if os.path.commonpath([path, directory]) == directory:
+            return location + '/' + urllib.parse.quote(os.path.relpath(path, directory))
+    return None
+
+
+def _set_cache_control(response: Response, immutable: bool, public: bool) -> None:
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    if immutable and public:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.s_maxage = SHARED_MAX_AGE
+        response.cache_control.immutable = True
+    elif immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = PRIVATE_MAX_AGE
+    else:
+        # Cheap to revalidate thanks to the ETag, and the content changes on rotation
+        response.cache_control.no_cache = True
+
+
+def not_modified(etag: str | None, weak: bool = False, immutable: bool = False, public: bool = False) -> Response | None:
+    """Return a 304 response if the client already has this version of the file."""
+    if etag is None:
+        return None
+    if not (request.if_none_match.contains_weak(etag) if weak else request.if_none_match.contains(etag)):
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag, weak=weak)
+    _set_cache_control(response, immutable, public)
+    return response
+
+
+def send_stored_file(path: str, etag: str | None, weak: bool = False, immutable: bool = False,
+                     public: bool = False, mimetype: str | None = None) -> Response:
+    """Send a file from a file store or the thumbnail cache."""
+    mode = current_app.config.get('FILE_DELIVERY_MODE', 'flask')
+    uri = accel_redirect_uri(path) if mode == 'x-accel-redirect' else None
+    if uri is not None:
+        # nginx takes care of the body, Range requests and Last-Modified
+        response = current_app.response_class(
+            mimetype=mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        )
+        response.headers['X-Accel-Redirect'] = uri
+        if etag is not None:
+            response.set_etag(etag, weak=weak)
+    else:
+        use_x_sendfile = mode == 'x-sendfile'
+        send_file_etag: bool | str
+        if etag is None:
+            # werkzeug's own, from the modification time and size
+            send_file_etag = True
+        elif weak:
+            send_file_etag = False
+        else:
+            send_file_etag = etag
+        response = send_file(
+            path, request.environ,
+            mimetype=mimetype,
+            # Range requests are left to the front server when it sends the file
+            conditional=not use_x_sendfile,
+            etag=send_file_etag,
+            use_x_sendfile=use_x_sendfile,
+            response_class=current_app.response_class,
+        )
+        if etag is not None and weak:
+            response.set_etag(etag, weak=True)
+    _set_cache_control(response, immutable, public)
+    return response
@@ -0,0 +1,171 @@
+import hashlib
+import mmap
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import IO
+
+import blake3
+
+from rhinventory.datatypes.hashes import BLAKE3Hash, Hashes, MD5Hash, SHA256Hash
+
+# Large reads keep the per-chunk overhead (thread handoff, syscalls) negligible
+# compared to the time spent inside the hash functions.
+HASHING_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Below this size the thread handoff costs more than it saves, hash serially.
+PARALLEL_HASHING_THRESHOLD = 4 * 1024 * 1024
+
+# Above this size BLAKE3 is allowed to split the input over all cores.
+BLAKE3_MULTITHREADING_THRESHOLD = 64 * 1024 * 1024
+
+
+@dataclass
+class HashingReport:
+    size: int
+    elapsed: float
+
+    @property
+    def throughput_mb_s(self) -> float:
+        if self.elapsed <= 0:
+            return 0.0
+        return self.size / self.elapsed / 1_000_000
+
+    def __str__(self) -> str:
+        return f"{self.size / 1_000_000:.1f} MB in {self.elapsed:.2f} s ({self.throughput_mb_s:.1f} MB/s)"
+
+
+class MultiHasher:
+    """
+    Computes MD5, SHA256 and BLAKE3 of a byte stream in a single pass.
+
+    With `parallel` enabled every digest is updated on its own thread.  All three
+    hash implementations release the GIL while hashing, so the digests actually run
+    concurrently, and `update` returns as soon as the work is handed off so the
+    caller can read the next chunk in the meantime.  Chunks passed to `update` must
+    not be modified afterwards.
+    """
+
+    def __init__(self, parallel: bool = True, blake3_multithreaded: bool = False) -> None:
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+        if blake3_multithreaded:
+            self._blake3 = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        else:
+            self._blake3 = blake3.blake3()
+
+        self._executor: ThreadPoolExecutor | None = None
+        if parallel:
+            self._executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="hasher")
+        self._pending: list[Future[None]] = []
+        self.size = 0
+
+    def wait(self) -> None:
+        """Block until all handed off chunks have been hashed."""
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
+    def update(self, chunk: bytes | memoryview) -> None:
+        self.size += len(chunk)
+        if self._executor is None:
+            self._md5.update(chunk)
+            self._sha256.update(chunk)
+            self._blake3.update(chunk)
+            return
+
+        # Only one chunk is in flight at a time so that memory use stays bounded.
+        self.wait()
+        self._pending = [
+            self._executor.submit(self._md5.update, chunk),
+            self._executor.submit(self._sha256.update, chunk),
+            self._executor.submit(self._blake3.update, chunk),
+        ]
+
+    def hashes(self) -> Hashes:
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        return Hashes(
+            md5=MD5Hash(self._md5.digest()),
+            sha256=SHA256Hash(self._sha256.digest()),
+            blake3=BLAKE3Hash(self._blake3.digest())
+        )
+
+
+def _get_size(file: IO[bytes]) -> int | None:
+    # Don't use fileno() here, on a SpooledTemporaryFile it forces a rollover to disk.
+    try:
+        position = file.tell()
+        size = file.seek(0, os.SEEK_END)
+        file.seek(position)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _hash_mmap(file: IO[bytes], hasher: MultiHasher) -> bool:
+    try:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        return False
+
+    with mapped:
+        view = memoryview(mapped)
+        try:
+            hasher.update(view)
+            hasher.wait()
+        finally:
+            view.release()
+    return True
+
+
+def hash_file(file: IO[bytes]) -> tuple[Hashes, HashingReport]:
+    """
+    Hash a seekable binary file-like object from the start.
+
+    Regular files are memory-mapped and hashed in one go, other streams are read in
+    `HASHING_BUFFER_SIZE` chunks.  The stream is rewound before returning.
+    """
+    start = time.perf_counter()
+    size = _get_size(file)
+    parallel = size is None or size >= PARALLEL_HASHING_THRESHOLD
+    hasher = MultiHasher(
+        parallel=parallel,
+        blake3_multithreaded=size is not None and size >= BLAKE3_MULTITHREADING_THRESHOLD
+    )
+
+    file.seek(0)
+    if not (parallel and _hash_mmap(file, hasher)):
+        while chunk := file.read(HASHING_BUFFER_SIZE):
+            hasher.update(chunk)
+    file.seek(0)
+
+    hashes = hasher.hashes()
+    return hashes, HashingReport(size=hasher.size, elapsed=time.perf_counter() - start)
+
+
+def copy_and_hash(source: IO[bytes], destination: IO[bytes]) -> tuple[Hashes, HashingReport]:
+    """
+    Copy `source` into `destination` and hash the data in the same pass.
+
+    Each chunk is written out while the previous one is still being hashed on the
+    worker threads, so the data is only read once.
+    """
+    start = time.perf_counter()
+    size = _get_size(source)
+    hasher = MultiHasher(
+        parallel=size is None or size >= PARALLEL_HASHING_THRESHOLD,
+        blake3_multithreaded=size is not None and size >= BLAKE3_MULTITHREADING_THRESHOLD
+    )
+
+    source.seek(0)
+    while chunk := source.read(HASHING_BUFFER_SIZE):
+        hasher.update(chunk)
+        destination.write(chunk)
+
+    hashes = hasher.hashes()
+    return hashes, HashingReport(size=hasher.size, elapsed=time.perf_counter() - start)
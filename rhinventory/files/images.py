@@ -0,0 +1,241 @@
+"""
+Image processing that works on plain paths rather than File objects.
+
+Everything here only takes and returns picklable values, so it can be run in
+worker processes (SQLAlchemy model instances can't be sent to those).
+"""
+import multiprocessing as mp
+import os
+from dataclasses import dataclass
+from typing import Any, Iterable
+
+from PIL import Image, ImageEnhance, ImageOps, features
+
+try:
+    from pyzbar import pyzbar
+except Exception as ex:
+    print("Warning: Failed to import zbar:", ex)
+    pyzbar = None
+
+THUMBNAIL_SIZE = (800, 800)
+BARCODE_IMAGE_SIZE = (1200, 1200)
+
+# Besides the full size thumbnail in the source format, thumbnails are made in
+# these sizes (bounding box edge in pixels) and in every supported modern format.
+THUMBNAIL_VARIANT_SIZES = (160, 400, 800)
+# In order of preference
+THUMBNAIL_VARIANT_FORMATS = ('avif', 'webp')
+THUMBNAIL_VARIANT_SAVE_OPTIONS: dict[str, dict[str, Any]] = {
+    'avif': {'quality': 60, 'speed': 8},
+    'webp': {'quality': 80, 'method': 4},
+}
+
+
+def supported_thumbnail_variant_formats() -> list[str]:
+    return [format for format in THUMBNAIL_VARIANT_FORMATS if features.check(format)]
+
+
+def thumbnail_variant_path(thumbnail_path: str, size: int, format: str) -> str:
+    """`uploads/photo_thumb.jpg` -> `uploads/photo_thumb_400.webp`"""
+    base, _ = os.path.splitext(thumbnail_path)
+    return f"{base}_{size}.{format}"
+
+
+def thumbnail_variant_paths(thumbnail_path: str) -> list[str]:
+    """All variant paths that may exist for the given thumbnail path."""
+    return [thumbnail_variant_path(thumbnail_path, size, format)
+            for size in THUMBNAIL_VARIANT_SIZES for format in THUMBNAIL_VARIANT_FORMATS]
+
+
+def _save_thumbnail_variants(im: Image.Image, thumbnail_path: str) -> None:
+    formats = supported_thumbnail_variant_formats()
+    if not formats:
+        return
+    if im.mode not in ('RGB', 'RGBA'):
+        im = im.convert('RGBA' if 'A' in im.getbands() or 'transparency' in im.info else 'RGB')
+
+    # Largest first, so that every step only has to shrink the previous one
+    for size in sorted(THUMBNAIL_VARIANT_SIZES, reverse=True):
+        im = im.copy()
+        im.thumbnail((size, size))
+        for format in formats:
+            im.save(thumbnail_variant_path(thumbnail_path, size, format), format=format.upper(),
+                    **THUMBNAIL_VARIANT_SAVE_OPTIONS[format])
+
+
+def _is_thumbnailable(path: str) -> bool:
+    # PDF and SVG files are not supported for thumbnail generation
+    return not (path.lower().endswith('.pdf') or path.lower().endswith('.svg'))
+
+
+def open_downscaled(path: str, size: int) -> Image.Image:
+    """
+    Open an image, downscaled to fit at least `size` x `size` pixels.
+
+    JPEGs are decoded in draft mode, which lets libjpeg scale them down by 1/2, 1/4
+    or 1/8 while decoding, so the full resolution bitmap is never materialized.
+    """
+    im = Image.open(path)
+    # no-op for formats other than JPEG
+    im.draft(None, (size, size))
+    im.thumbnail((size, size))
+    return im
+
+
+def _save_thumbnail(im: Image.Image, thumbnail_path: str, size: tuple[int, int] = THUMBNAIL_SIZE) -> None:
+    """Save the thumbnail and its variants from an already (at least partly) downscaled image."""
+    im = im.copy()
+    im.thumbnail(size)
+    # Transposing after downscaling is much cheaper, the EXIF data is kept by thumbnail()
+    im = ImageOps.exif_transpose(im)
+    im.save(thumbnail_path)
+    _save_thumbnail_variants(im, thumbnail_path)
+
+
+def make_thumbnail(path: str, thumbnail_path: str, size: tuple[int, int] = THUMBNAIL_SIZE) -> bool:
+    if not _is_thumbnailable(path):
+        return False
+    im = open_downscaled(path, max(size))
+    _save_thumbnail(im, thumbnail_path, size)
+    return True
+
+
+def rotate_thumbnail(thumbnail_path: str, rotation: int) -> bool:
+    """
+    Rotate an existing thumbnail and its variants clockwise by `rotation` degrees,
+    which is much cheaper than decoding the original again.
+
+    :return: False if there is no thumbnail to rotate
+    """
+    if not os.path.exists(thumbnail_path):
+        return False
+    with Image.open(thumbnail_path) as im:
+        im.load()
+        thumbnail_format = im.format
+    # Thumbnails are saved upright already, transpose() is exact unlike rotate()
+    transpose = {
+        90: Image.Transpose.ROTATE_270,
+        180: Image.Transpose.ROTATE_180,
+        270: Image.Transpose.ROTATE_90,
+    }[rotation % 360]
+    im = im.transpose(transpose)
+    im.save(thumbnail_path, format=thumbnail_format)
+    for size in THUMBNAIL_VARIANT_SIZES:
+        for format in THUMBNAIL_VARIANT_FORMATS:
+            variant_path = thumbnail_variant_path(thumbnail_path, size, format)
+            if not os.path.exists(variant_path):
+                continue
+            with Image.open(variant_path) as variant:
+                variant = variant.transpose(transpose)
+            variant.save(variant_path, format=format.upper(), **THUMBNAIL_VARIANT_SAVE_OPTIONS[format])
+    return True
+
+
+def make_thumbnail_variant(path: str, variant_path: str, size: int, format: str) -> None:
+    """Write a single thumbnail of at most `size` pixels in the given format."""
+    im = open_downscaled(path, size)
+    im = ImageOps.exif_transpose(im)
+    if format == 'jpeg':
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        im.save(variant_path, format='JPEG', quality=85)
+        return
+    if im.mode not in ('RGB', 'RGBA'):
+        im = im.convert('RGBA' if 'A' in im.getbands() or 'transparency' in im.info else 'RGB')
+    im.save(variant_path, format=format.upper(), **THUMBNAIL_VARIANT_SAVE_OPTIONS[format])
+
+
+def _decode_barcodes(im: Image.Image, symbols=None):
+    """Detect barcodes in an image that has already been downscaled to `BARCODE_IMAGE_SIZE`."""
+    try:
+        im = ImageEnhance.Color(im).enhance(0)
+        im = ImageEnhance.Contrast(im).enhance(2)
+        im = ImageEnhance.Sharpness(im).enhance(-1)
+    except ValueError:
+        return None
+
+    if symbols:
+        return pyzbar.decode(im, symbols=symbols)
+    else:
+        return pyzbar.decode(im)
+
+
+def _rh_asset_id_from_barcodes(barcodes) -> int | None:
+    if not barcodes:
+        return None
+    for barcode in barcodes:
+        if barcode.type == "CODE128" and barcode.data.decode('utf-8').startswith("RH") or barcode.data.decode('utf-8').startswith("HH"):
+            try:
+                asset_id = int(barcode.data.decode('utf-8')[2:])
+            except Exception:
+                continue
+            return asset_id
+    return None
+
+
+def read_barcodes(path: str, symbols=None):
+    if pyzbar is None:
+        print("Warning: pyzbar was not found, thus no barcode detection was done.")
+        return None
+
+    if path.lower().endswith('.svg'):
+        return None
+    im = open_downscaled(path, max(BARCODE_IMAGE_SIZE))
+    return _decode_barcodes(im, symbols=symbols)
+
+
+def read_rh_barcode(path: str) -> int | None:
+    if not pyzbar:
+        return None
+
+    # only read CODE128 to speed up decoding
+    return _rh_asset_id_from_barcodes(read_barcodes(path, symbols=[pyzbar.ZBarSymbol.CODE128]))
+
+
+@dataclass
+class ImageTask:
+    path: str
+    # Where to write the thumbnail, or None to skip thumbnailing
+    thumbnail_path: str | None = None
+    read_barcode: bool = False
+
+
+@dataclass
+class ImageTaskResult:
+    thumbnail_created: bool = False
+    asset_id: int | None = None
+    error: str | None = None
+
+
+def run_image_task(task: ImageTask) -> ImageTaskResult:
+    """Barcode detection and thumbnailing share a single downscaled decode of the image."""
+    result = ImageTaskResult()
+    read_barcode = task.read_barcode and pyzbar is not None and not task.path.lower().endswith('.svg')
+    make_thumbnail = task.thumbnail_path is not None and _is_thumbnailable(task.path)
+    if not read_barcode and not make_thumbnail:
+        return result
+
+    try:
+        size = max(BARCODE_IMAGE_SIZE) if read_barcode else max(THUMBNAIL_SIZE)
+        im = open_downscaled(task.path, size)
+        if read_barcode:
+            # only read CODE128 to speed up decoding
+            result.asset_id = _rh_asset_id_from_barcodes(_decode_barcodes(im, symbols=[pyzbar.ZBarSymbol.CODE128]))
+        if make_thumbnail:
+            assert task.thumbnail_path
+            _save_thumbnail(im, task.thumbnail_path)
+            result.thumbnail_created = True
+    except Exception as ex:
+        # A single broken image shouldn't fail the whole batch
+        result.error = repr(ex)
+    return result
+
+
+def run_image_tasks(tasks: Iterable[ImageTask], multiprocessing: bool = True) -> list[ImageTaskResult]:
+    """Run the given tasks, on all cores if `multiprocessing` is enabled.  Results are in task order."""
+    tasks = list(tasks)
+    if not multiprocessing or len(tasks) < 2:
+        return [run_image_task(task) for task in tasks]
+
+    with mp.Pool(min(mp.cpu_count(), len(tasks))) as pool:
+        return pool.map(run_image_task, tasks, chunksize=1)
@@ -0,0 +1,163 @@
+"""
+Lossless JPEG rotation by editing the EXIF orientation tag.
+
+The compressed image data is never touched: the orientation is patched in place
+when the file already has the tag, otherwise the EXIF segment is rewritten.
+Everything that displays or thumbnails images honours the tag.
+"""
+import os
+import secrets
+import struct
+from typing import BinaryIO
+
+from PIL import Image
+
+ORIENTATION_TAG = 0x0112
+
+# EXIF orientation after rotating the displayed image clockwise by 90 degrees
+_ROTATE_90 = {1: 6, 6: 3, 3: 8, 8: 1, 2: 7, 7: 4, 4: 5, 5: 2}
+
+_EXIF_HEADER = b'Exif\x00\x00'
+_SOI = b'\xff\xd8'
+# Markers that have no length field
+_STANDALONE_MARKERS = {0x01, *range(0xd0, 0xd8)}
+_SOS = 0xda
+_APP0 = 0xe0
+_APP1 = 0xe1
+_TIFF_SHORT = 3
+
+
+def rotate_orientation(orientation: int, rotation: int) -> int:
+    """Orientation tag value after rotating the displayed image clockwise by `rotation` degrees."""
+    if rotation % 90 != 0:
+        raise ValueError(f"Unsupported rotation: {rotation}")
+    if orientation not in _ROTATE_90:
+        orientation = 1
+    for _ in range((rotation // 90) % 4):
+        orientation = _ROTATE_90[orientation]
+    return orientation
+
+
+def _segments(f: BinaryIO):
+    """Yield the marker and the start, payload and end offsets of every segment before the image data."""
+    f.seek(0)
+    if f.read(2) != _SOI:
+        raise ValueError("Not a JPEG file")
+    while True:
+        offset = f.tell()
+        header = f.read(2)
+        if len(header) < 2 or header[0] != 0xff:
+            raise ValueError("Corrupt JPEG file")
+        marker = header[1]
+        # Markers may be preceded by fill bytes
+        while marker == 0xff:
+            marker = f.read(1)[0]
+        if marker in _STANDALONE_MARKERS:
+            continue
+        if marker == _SOS:
+            return
+        # The length includes the length field itself
+        end = f.tell() + struct.unpack('>H', f.read(2))[0]
+        yield marker, offset, f.tell(), end
+        f.seek(end)
+
+
+def _find_exif_segment(f: BinaryIO) -> tuple[int, int, int] | None:
+    """Return the start, payload and end offsets of the EXIF APP1 segment, if there is one."""
+    for marker, start, payload, end in _segments(f):
+        if marker == _APP1:
+            f.seek(payload)
+            if f.read(len(_EXIF_HEADER)) == _EXIF_HEADER:
+                return start, payload, end
+    return None
+
+
+def _find_orientation_value(f: BinaryIO) -> tuple[int, str] | None:
+    """Return the file offset of the orientation value in IFD0 and the TIFF byte order."""
+    segment = _find_exif_segment(f)
+    if segment is None:
+        return None
+    _, payload, end = segment
+    tiff_offset = payload + len(_EXIF_HEADER)
+    f.seek(tiff_offset)
+    tiff = f.read(end - tiff_offset)
+
+    byte_order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if byte_order is None:
+        return None
+    ifd_offset, = struct.unpack(byte_order + 'I', tiff[4:8])
+    if ifd_offset + 2 > len(tiff):
+        return None
+    entry_count, = struct.unpack(byte_order + 'H', tiff[ifd_offset:ifd_offset + 2])
+    for i in range(entry_count):
+        entry_offset = ifd_offset + 2 + i * 12
+        if entry_offset + 12 > len(tiff):
+            break
+        tag, type, count = struct.unpack(byte_order + 'HHI', tiff[entry_offset:entry_offset + 8])
+        if tag == ORIENTATION_TAG:
+            if type != _TIFF_SHORT or count != 1:
+                return None
+            return tiff_offset + entry_offset + 8, byte_order
+    return None
+
+
+def get_orientation(path: str) -> int:
+    with Image.open(path) as im:
+        return im.getexif().get(ORIENTATION_TAG, 1)
+
+
+def set_orientation(path: str, orientation: int) -> None:
+    """Set the EXIF orientation of a JPEG file without recompressing it."""
+    with open(path, 'r+b') as f:
+        found = _find_orientation_value(f)
+        if found is not None:
+            value_offset, byte_order = found
+            f.seek(value_offset)
+            f.write(struct.pack(byte_order + 'H', orientation))
+            return
+
+    _rewrite_exif(path, orientation)
+
+
+def _rewrite_exif(path: str, orientation: int) -> None:
+    """Replace (or add) the EXIF segment with one containing the orientation tag."""
+    with Image.open(path) as im:
+        exif = im.getexif()
+    exif[ORIENTATION_TAG] = orientation
+    payload = exif.tobytes()
+    if len(payload) + 2 > 0xffff:
+        raise ValueError("EXIF data too large")
+    new_segment = struct.pack('>BBH', 0xff, _APP1, len(payload) + 2) + payload
+
+    with open(path, 'rb') as f:
+        existing = _find_exif_segment(f)
+        # JFIF requires its APP0 segment to come first
+        insert_at = 2
+        for marker, _, _, end in _segments(f):
+            if marker == _APP0:
+                insert_at = end
+            break
+        if existing is not None:
+            insert_at = existing[0]
+
+        temporary_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{secrets.token_hex(4)}.part")
+        try:
+            with open(temporary_path, 'xb') as out:
+                f.seek(0)
+                out.write(f.read(insert_at))
+                out.write(new_segment)
+                if existing is not None:
+                    f.seek(existing[2])
+                while chunk := f.read(1024 * 1024):
+                    out.write(chunk)
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+
+def rotate(path: str, rotation: int) -> None:
+    """Rotate a JPEG file clockwise by `rotation` degrees, losslessly."""
+    if rotation % 360 == 0:
+        return
+    set_orientation(path, rotate_orientation(get_orientation(path), rotation))
@@ -0,0 +1,199 @@
+"""
+On-demand thumbnail generation backed by a size-capped disk cache.
+
+Thumbnails made at upload time (the `_thumb` file and its variants next to the
+original) are served as they are, anything else is generated on first request,
+stored in the cache directory and evicted least-recently-used first once the
+cache grows over its size limit.
+"""
+import fcntl
+import os
+import secrets
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+
+from flask import current_app
+
+from rhinventory.files import images
+
+if TYPE_CHECKING:
+    from rhinventory.models.file import File
+
+DEFAULT_THUMBNAIL_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+# Format used for clients that accept none of the variant formats
+FALLBACK_THUMBNAIL_FORMAT = 'jpeg'
+
+# Access times are only refreshed this often, to avoid a metadata write on every hit
+_TOUCH_INTERVAL = 60 * 60
+
+# Once over the limit, evict down to this fraction of it so that eviction doesn't run on every write
+_EVICT_TO_FRACTION = 0.9
+
+# The size of the cache is tracked as entries are added, but other processes add entries
+# too, so the directory is scanned again at least every this many new entries
+_EVICT_SCAN_INTERVAL = 100
+
+
+class ThumbnailCache:
+    def __init__(self, directory: str, max_size: int) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self._locks_directory = os.path.join(directory, '.locks')
+        os.makedirs(self._locks_directory, exist_ok=True)
+        # Size as of the last scan plus what this process added since, None before the first scan
+        self._size: int | None = None
+        self._added_since_scan = 0
+
+    @contextmanager
+    def _lock(self, name: str, blocking: bool = True) -> Iterator[bool]:
+        # flock works across gunicorn workers as well as across threads
+        with open(os.path.join(self._locks_directory, name + '.lock'), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _touch(self, path: str) -> None:
+        try:
+            if os.stat(path).st_mtime < time.time() - _TOUCH_INTERVAL:
+                os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def get_or_create(self, key: str, create: Callable[[str], None]) -> str:
+        """
+        Return the path of the cache entry `key`, calling `create` with a temporary
+        path to write it first if it doesn't exist yet.  Creation is serialized per
+        key, so concurrent requests for one thumbnail only make it once.
+        """
+        path = os.path.join(self.directory, key)
+        if os.path.exists(path):
+            self._touch(path)
+            return path
+
+        with self._lock(key):
+            if os.path.exists(path):
+                return path
+            temporary_path = os.path.join(self.directory, f".{key}.{secrets.token_hex(4)}.part")
+            try:
+                create(temporary_path)
+                os.replace(temporary_path, path)
+            finally:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+
+        self._added(os.path.getsize(path))
+        return path
+
+    def _added(self, size: int) -> None:
+        self._added_since_scan += 1
+        if self._size is not None:
+            self._size += size
+        if self._size is None or self._size > self.max_size or self._added_since_scan >= _EVICT_SCAN_INTERVAL:
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used entries, and their locks, while the cache is over its size limit."""
+        with self._lock('evict', blocking=False) as acquired:
+            if not acquired:
+                # someone else is already evicting
+                return
+
+            self._added_since_scan = 0
+
+            entries: list[tuple[float, int, str]] = []
+            total_size = 0
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.startswith('.') or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+
+            if total_size > self.max_size:
+                entries.sort()
+                for _, size, path in entries:
+                    if total_size <= self.max_size * _EVICT_TO_FRACTION:
+                        break
+                    for evicted_path in (path, os.path.join(self._locks_directory, os.path.basename(path) + '.lock')):
+                        try:
+                            os.remove(evicted_path)
+                        except FileNotFoundError:
+                            pass
+                    total_size -= size
+            self._size = total_size
+
+
+def get_thumbnail_cache() -> ThumbnailCache:
+    cache = current_app.extensions.get('thumbnail_cache')
+    if cache is None:
+        directory = current_app.config.get('THUMBNAIL_CACHE_DIR') or os.path.join(
+            current_app.config['FILE_STORE_LOCATIONS'][current_app.config['DEFAULT_FILE_STORE']],
+            '.thumbnail_cache'
+        )
+        max_size = current_app.config.get('THUMBNAIL_CACHE_MAX_SIZE') or DEFAULT_THUMBNAIL_CACHE_MAX_SIZE
+        cache = ThumbnailCache(os.path.abspath(directory), max_size)
+        current_app.extensions['thumbnail_cache'] = cache
+    return cache
+
+
+def thumbnail_size(size: int | None) -> int:
+    """Round a requested size up to the next standard size, so that the cache stays small."""
+    if size is None:
+        return max(images.THUMBNAIL_VARIANT_SIZES)
+    return min([s for s in images.THUMBNAIL_VARIANT_SIZES if s >= size] or [max(images.THUMBNAIL_VARIANT_SIZES)])
+
+
+def thumbnail_format(accepted_formats: Iterable[str]) -> str:
+    """The preferred supported format among those the client accepts."""
+    accepted_formats = set(accepted_formats)
+    supported_formats = images.supported_thumbnail_variant_formats()
+    return next((f for f in images.THUMBNAIL_VARIANT_FORMATS if f in accepted_formats and f in supported_formats),
+                FALLBACK_THUMBNAIL_FORMAT)
+
+
+def get_thumbnail(file: "File", size: int | None, accepted_formats: Iterable[str]) -> tuple[str, str | None] | None:
+    """
+    Find or generate the thumbnail of a file for the requested size and formats.
+
+    :return: path and mimetype (None if it should be guessed from the path),
+        or None if the file can't have a thumbnail
+    """
+    size = thumbnail_size(size)
+    format = thumbnail_format(accepted_formats)
+
+    # Thumbnails made at upload time are pre-warmed cache entries
+    if file.has_thumbnail:
+        if format == FALLBACK_THUMBNAIL_FORMAT:
+            if size == max(images.THUMBNAIL_VARIANT_SIZES) and os.path.exists(file.full_filepath_thumbnail):
+                return file.full_filepath_thumbnail, None
+        else:
+            variant_path = os.path.join(file._file_store_path, images.thumbnail_variant_path(file.filepath_thumbnail, size, format))
+            if os.path.exists(variant_path):
+                return variant_path, f'image/{format}'
+
+    if not file.can_have_thumbnail:
+        return None
+
+    # The upload time thumbnail is much cheaper to decode than the original
+    source_path = file.full_filepath
+    if file.has_thumbnail and os.path.exists(file.full_filepath_thumbnail):
+        source_path = file.full_filepath_thumbnail
+
+    # The version is part of the key, so rotating an image or remaking its thumbnail invalidates its entries
+    key = f"{file.id}-{file.thumbnail_version}-{size}.{format}"
+
+    cache = get_thumbnail_cache()
+    path = cache.get_or_create(
+        key,
+        create=lambda path: images.make_thumbnail_variant(source_path, path, size, format)
+    )
+    return path, f'image/{format}'
@@ -0,0 +1,102 @@
+"""
+Uploaded files are streamed by werkzeug straight into the upload directory of the
+target file store and hashed while they are written, so storing them is just a rename.
+"""
+import os
+import secrets
+import time
+from pathlib import Path
+from typing import IO, Any
+
+from flask import Request, current_app
+
+from rhinventory.datatypes.hashes import Hashes
+from rhinventory.files.hashing import BLAKE3_MULTITHREADING_THRESHOLD, PARALLEL_HASHING_THRESHOLD, \
+    HashingReport, MultiHasher
+from rhinventory.models.file import FileStore
+
+UPLOAD_DIRECTORY = 'uploads'
+
+
+def upload_directory() -> tuple[FileStore, str]:
+    """The default file store and the absolute path of its upload directory, which is created if needed."""
+    file_store = FileStore(current_app.config['DEFAULT_FILE_STORE'])
+    files_dir = current_app.config['FILE_STORE_LOCATIONS'][file_store.value]
+    assert isinstance(files_dir, str)
+    path = os.path.join(files_dir, UPLOAD_DIRECTORY)
+    os.makedirs(path, exist_ok=True)
+    return file_store, path
+
+
+class HashingUploadStream:
+    """
+    A temporary file in the upload directory that hashes everything written into it.
+
+    Unless `claim` is called, the file is removed when the stream is closed, which
+    werkzeug does at the end of the request.
+    """
+
+    def __init__(self, file_store: FileStore, directory: str, total_content_length: int | None) -> None:
+        self.file_store = file_store
+        # The temporary file lives in the same directory as the final file so that
+        # it can be renamed into place.
+        self.path = Path(directory) / f".upload-{secrets.token_hex(8)}.part"
+        self._file: IO[bytes] = open(self.path, 'xb+')
+        self._hasher = MultiHasher(
+            parallel=total_content_length is None or total_content_length >= PARALLEL_HASHING_THRESHOLD,
+            blake3_multithreaded=total_content_length is not None and total_content_length >= BLAKE3_MULTITHREADING_THRESHOLD
+        )
+        self._start = time.perf_counter()
+        self._result: tuple[Hashes, HashingReport] | None = None
+        self.claimed = False
+
+    def write(self, data: bytes) -> int:
+        self._hasher.update(data)
+        return self._file.write(data)
+
+    def _finish(self) -> tuple[Hashes, HashingReport]:
+        if self._result is None:
+            self._file.flush()
+            hashes = self._hasher.hashes()
+            self._result = hashes, HashingReport(size=self._hasher.size, elapsed=time.perf_counter() - self._start)
+        return self._result
+
+    def claim(self) -> tuple[Hashes, HashingReport]:
+        """Take over the file at `path`, it is no longer removed on close."""
+        self.claimed = True
+        return self._finish()
+
+    def close(self) -> None:
+        self._finish()
+        self._file.close()
+        if not self.claimed and self.path.exists():
+            os.remove(self.path)
+
+    def __getattr__(self, name: str) -> Any:
+        # read, seek, tell etc. of the underlying file
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """Request class that streams uploaded files into the file store, see `HashingUploadStream`."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._upload_streams: list[HashingUploadStream] = []
+
+    def _get_file_stream(
+            self,
+            total_content_length: int | None,
+            content_type: str | None,
+            filename: str | None = None,
+            content_length: int | None = None) -> IO[bytes]:
+        file_store, directory = upload_directory()
+        stream = HashingUploadStream(file_store, directory, total_content_length)
+        self._upload_streams.append(stream)
+        return stream  # type: ignore[return-value]
+
+    def close(self) -> None:
+        super().close()
+        # Also the files of a form that failed to parse, werkzeug doesn't know about those
+        for stream in self._upload_streams:
+            stream.close()
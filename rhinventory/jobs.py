@@ -0,0 +1,118 @@
+"""
+Local, database-backed job queue for post-upload file processing.
+
+Jobs are enqueued by the upload views and processed by `python -m rhinventory.worker`.
+Any number of workers can run at once: queued jobs are claimed with
+`SELECT ... FOR UPDATE SKIP LOCKED`, and the file row is locked while a job runs
+so that jobs on the same file (e.g. auto assign, which renames the file, and
+thumbnailing) never run concurrently.
+"""
+import os
+import traceback
+from datetime import datetime, timedelta
+from typing import Iterable
+
+from rhinventory.extensions import db
+from rhinventory.models.file import File
+from rhinventory.models.job import Job, JobStatus, JobType, PENDING_JOB_STATUSES
+
+MAX_ATTEMPTS = 3
+
+
+def enqueue(file: File, job_type: JobType) -> Job:
+    """Add a job for a file to the queue.  The file must already have an id; commit afterwards."""
+    assert file.id is not None
+    job = Job(type=job_type, file_id=file.id, status=JobStatus.queued)
+    db.session.add(job)
+    return job
+
+
+def enqueue_file_processing(files: Iterable[File], auto_assign: bool = False) -> list[Job]:
+    """Enqueue the usual post-upload processing for the given files."""
+    jobs: list[Job] = []
+    for file in files:
+        if file.size is None:
+            jobs.append(enqueue(file, JobType.size))
+        if file.md5 is None or file.sha256 is None or file.blake3 is None:
+            jobs.append(enqueue(file, JobType.hashes))
+        if file.is_image:
+            if auto_assign and not file.asset_id:
+                jobs.append(enqueue(file, JobType.auto_assign))
+            jobs.append(enqueue(file, JobType.thumbnail))
+    return jobs
+
+
+def count_pending_jobs(file_ids: Iterable[int]) -> int:
+    file_ids = list(file_ids)
+    if not file_ids:
+        return 0
+    return db.session.query(Job).filter(
+        Job.file_id.in_(file_ids),
+        Job.status.in_(PENDING_JOB_STATUSES),
+    ).count()
+
+
+def claim_next_job() -> Job | None:
+    """Mark the oldest queued job as running and return it, or None if the queue is empty."""
+    job = db.session.query(Job).filter(
+        Job.status == JobStatus.queued
+    ).order_by(Job.id.asc()).with_for_update(skip_locked=True).first()
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.status = JobStatus.running
+    job.started_at = datetime.now()
+    job.attempts += 1
+    db.session.commit()
+    return job
+
+
+def requeue_stale_jobs(older_than: timedelta = timedelta(hours=1)) -> int:
+    """Put jobs left running by a crashed worker back into the queue."""
+    count = db.session.query(Job).filter(
+        Job.status == JobStatus.running,
+        Job.started_at < datetime.now() - older_than,
+    ).update({Job.status: JobStatus.queued}, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def _process(job: Job, file: File) -> None:
+    match job.type:
+        case JobType.thumbnail:
+            file.make_thumbnail()
+        case JobType.auto_assign:
+            try:
+                file.auto_assign()
+            except ValueError:
+                # Probably failed to assign file to asset because asset doesn't exist
+                # Ignore this
+                pass
+        case JobType.size:
+            file.size = os.path.getsize(file.full_filepath)
+        case JobType.hashes:
+            file.calculate_hashes()
+        case _:
+            raise ValueError(f"Unsupported job type: {job.type}")
+
+
+def run_job(job: Job) -> None:
+    """Run a claimed job and record its outcome."""
+    try:
+        file = db.session.get(File, job.file_id, with_for_update=True)
+        if file is None or file.is_deleted:
+            job.status = JobStatus.done
+        else:
+            _process(job, file)
+            job.status = JobStatus.done
+        job.finished_at = datetime.now()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        job = db.session.get(Job, job.id)
+        assert job is not None
+        job.error = traceback.format_exc()
+        job.status = JobStatus.queued if job.attempts < MAX_ATTEMPTS else JobStatus.failed
+        job.finished_at = datetime.now()
+        db.session.commit()
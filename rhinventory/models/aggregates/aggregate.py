@@ -23,10 +23,22 @@ class Aggregate(db.Model):
     def filter_from_event(cls, event: listen_for_events_type) -> ColumnElement[bool] | bool:
         raise NotImplementedError()
 
+    @classmethod
+    def identity_from_event(cls, event: listen_for_events_type) -> UUID | None:
+        """
+        Primary key of the aggregate the event applies to, or None if it can't be
+        derived from the event alone, in which case `filter_from_event` is used.
+        """
+        return None
+
     def apply_event(self, event: listen_for_events_type) -> None:
         raise NotImplementedError()
 
 registered_aggregate_classes: list[type[Aggregate]] = []
+# Event class -> aggregate classes listening for it, in registration order
+aggregate_classes_by_event_class: dict[type[Any], list[type[Aggregate]]] = {}
 def registered_aggregate_class(cls: type[Aggregate]) -> type[Aggregate]:
     registered_aggregate_classes.append(cls)
+    for event_class in cls.listen_for_event_classes:
+        aggregate_classes_by_event_class.setdefault(event_class, []).append(cls)
     return cls
@@ -46,6 +46,17 @@ class FileAggregate(Aggregate):
             case _:
                 raise ValueError(f"Unsupported event type: {type(event)}")
 
+    @classmethod
+    def identity_from_event(cls, event: listen_for_events_type) -> UUID | None:
+        match event:
+            case FileConverted():
+                if event.output_file_metadata:
+                    return blake3_to_file_aggregate_id(event.output_file_metadata.checksums.blake3)
+                else:
+                    return None
+            case _:
+                raise ValueError(f"Unsupported event type: {type(event)}")
+
     def apply_event(self, event: listen_for_events_type) -> None:
         self.last_event_id = event.event_id
         match event:
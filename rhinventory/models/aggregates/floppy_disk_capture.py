@@ -62,6 +62,9 @@ class FloppyDiskCapture(Aggregate):
             case _:
                 raise ValueError(f"Unsupported event type: {type(event)}")
 
+    @classmethod
+    def identity_from_event(cls, event: listen_for_events_type) -> UUID:
+        return event.floppy_disk_capture_id
 
     def apply_event(self, event: listen_for_events_type) -> None:
         self.id = event.floppy_disk_capture_id
@@ -1,4 +1,5 @@
 import datetime
+from uuid import UUID
 
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy_utils.expressions import ColumnElement
@@ -27,6 +28,14 @@ class Statement(Aggregate):
             case StatementCreated():
                 return cls.id == event.event_id
 
+    @classmethod
+    def identity_from_event(cls, event: StatementCreated | StatementDeleted) -> UUID:
+        match event:
+            case StatementDeleted():
+                return event.statement_id
+            case StatementCreated():
+                return event.event_id
+
     def apply_event(self, event: StatementCreated | StatementDeleted) -> None:
         match event:
             case StatementDeleted():
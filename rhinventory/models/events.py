@@ -1,7 +1,7 @@
 from typing import Any
 from datetime import datetime
 from uuid import UUID
-from sqlalchemy import ForeignKey
+from sqlalchemy import BigInteger, ForeignKey, Identity, Index
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -42,18 +42,39 @@ class EventSession(db.Model):
 
 class DBEvent(db.Model):
     __tablename__ = 'events'
+    __table_args__ = (
+        # Latest events of an asset, see AssetView.details_view
+        Index('ix_events_related_asset_id_ingested_at', 'related_asset_id', 'ingested_at'),
+        # Replays and catching up read the events of some classes in position order
+        Index('ix_events_class_name_position', 'class_name', 'position'),
+    )
 
     id: Mapped[UUID] = mapped_column(primary_key=True)
+    # Order in which events were stored, aggregate checkpoints refer to it
+    position: Mapped[int] = mapped_column(BigInteger, Identity(), unique=True)
 
     namespace: Mapped[str] = mapped_column(index=True)
-    class_name: Mapped[str] = mapped_column(index=True)
+    class_name: Mapped[str] = mapped_column()
     timestamp: Mapped[datetime] = mapped_column()
     ingested_at: Mapped[datetime] = mapped_column()
     event_session_id: Mapped[int] = mapped_column(ForeignKey('event_sessions.id'))
 
     data: Mapped[dict[Any, Any]] = mapped_column(JSONB)
+    # Asset named by the event, copied out of `data` on ingest so it can be indexed.
+    # Not a foreign key, events may name assets that don't exist (anymore).
+    related_asset_id: Mapped[int | None] = mapped_column()
 
     # INFO: Here you could do something like
     # name = index_property("data", "name")
 
     event_session: Mapped[EventSession] = relationship()
+
+
+class AggregateCheckpoint(db.Model):
+    """Position of the last event that has been applied to an aggregate table."""
+    __tablename__ = 'aggregate_checkpoints'
+    rhinventory_log = False
+
+    aggregate_table: Mapped[str] = mapped_column(primary_key=True)
+    position: Mapped[int] = mapped_column(BigInteger, default=0)
+    updated_at: Mapped[datetime | None] = mapped_column(default=datetime.now, onupdate=datetime.now)
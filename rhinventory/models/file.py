@@ -1,7 +1,6 @@
 import datetime
 import os
 import enum
-import subprocess
 from typing import TYPE_CHECKING, Literal
 
 from PIL.ImageFile import ImageFile
@@ -9,19 +8,16 @@ from flask import current_app, url_for
 from sqlalchemy import BigInteger, Integer, String, Text, \
     DateTime, LargeBinary, ForeignKey, Enum, Boolean
 from sqlalchemy.orm import Relationship, relationship, Mapped, mapped_column
-from PIL import Image, ImageEnhance, ImageOps
+from PIL import Image
 
 from rhinventory.models.enums import Privacy
 from rhinventory.models.user import User
 if TYPE_CHECKING:
     from rhinventory.db import Asset, Transaction
-try:
-    from pyzbar import pyzbar
-except Exception as ex:
-    print("Warning: Failed to import zbar:", ex)
-    pyzbar = None
 
 from rhinventory.extensions import db
+from rhinventory.files import images, jpeg
+from rhinventory.files.hashing import hash_file
 
 
 class FileStore(enum.Enum):
@@ -89,11 +85,11 @@ class File(db.Model):
     asset_id: Mapped[int | None] = mapped_column(ForeignKey('assets.id'))
     transaction_id: Mapped[int | None] = mapped_column(ForeignKey('transactions.id'))
     benchmark_id: Mapped[int | None] = mapped_column(ForeignKey('benchmark.id'))
-    md5: Mapped[bytes | None] = mapped_column(LargeBinary(16))
-    original_md5: Mapped[bytes | None] = mapped_column(LargeBinary(16))
-    sha256: Mapped[bytes | None] = mapped_column(LargeBinary(32))
+    md5: Mapped[bytes | None] = mapped_column(LargeBinary(16), index=True)
+    original_md5: Mapped[bytes | None] = mapped_column(LargeBinary(16), index=True)
+    sha256: Mapped[bytes | None] = mapped_column(LargeBinary(32), index=True)
     original_sha256: Mapped[bytes | None] = mapped_column(LargeBinary(32))
-    blake3: Mapped[bytes | None] = mapped_column(LargeBinary(32))
+    blake3: Mapped[bytes | None] = mapped_column(LargeBinary(32), index=True)
     is_deleted: Mapped[bool | None] = mapped_column(default=False)
     size: Mapped[int] = mapped_column(BigInteger, nullable=True)
 
@@ -109,7 +105,7 @@ class File(db.Model):
     # TODO constraint on only one asset/transaction/benchmark relationship
     #CheckConstraint()
 
-    THUMBNAIL_SIZE = (800, 800)
+    THUMBNAIL_SIZE = images.THUMBNAIL_SIZE
 
     def __repr__(self) -> str:
         return f'<File {self.id} {self.filepath}>'
@@ -127,6 +123,16 @@ class File(db.Model):
     def thumbnail_file_exists(self) -> bool:
         return os.path.exists(self.full_filepath_thumbnail)
     
+    @property
+    def filepaths_thumbnail_variants(self) -> list[str]:
+        '''All possible thumbnail variant paths, they don't necessarily exist'''
+        return images.thumbnail_variant_paths(self.filepath_thumbnail)
+    
+    @property
+    def can_have_thumbnail(self) -> bool:
+        '''Whether a thumbnail can be generated for this file, on upload or on demand'''
+        return self.is_image and self.file_extension.lower() not in ('pdf', 'svg')
+    
     @property
     def filename(self) -> str:
         return self.filepath.split('/')[-1]
@@ -147,13 +153,36 @@ class File(db.Model):
     def full_filepath_thumbnail(self) -> str:
         return os.path.join(self._file_store_path, self.filepath_thumbnail)
 
+    @property
+    def content_version(self) -> str | None:
+        '''Short content hash, changes whenever the file does (e.g. on rotation)'''
+        hash = self.blake3 or self.md5 or self.sha256
+        if hash is None:
+            return None
+        return hash.hex()[:16]
+    
+    @property
+    def thumbnail_version(self) -> str | None:
+        '''Content version plus when the thumbnail was made, thumbnails can be remade without the content changing'''
+        version = self.content_version
+        if version is None or not self.has_thumbnail:
+            return version
+        try:
+            made_at = os.stat(self.full_filepath_thumbnail).st_mtime_ns // 1_000_000
+        except FileNotFoundError:
+            return version
+        return f"{version}-{made_at:x}"
+    
     @property
     def url(self) -> str:
-        return url_for('file', file_id=self.id, filename=self.filename)
+        return url_for('file', file_id=self.id, filename=self.filename, v=self.content_version)
     
     @property
     def url_thumbnail(self) -> str:
-        return url_for('file', file_id=self.id, filename=self.filename, thumb=True)
+        return url_for('file', file_id=self.id, filename=self.filename, thumb=True, v=self.thumbnail_version)
+    
+    def url_thumbnail_sized(self, size: int) -> str:
+        return url_for('file', file_id=self.id, filename=self.filename, thumb=True, size=size, v=self.thumbnail_version)
     
     def open_image(self) -> None | ImageFile:
         if not self.is_image:
@@ -168,6 +197,10 @@ class File(db.Model):
             os.remove(self.full_filepath)
         if self.full_filepath_thumbnail and os.path.exists(self.full_filepath_thumbnail):
             os.remove(self.full_filepath_thumbnail)
+        for filepath_variant in self.filepaths_thumbnail_variants:
+            full_filepath_variant = os.path.join(self._file_store_path, filepath_variant)
+            if os.path.exists(full_filepath_variant):
+                os.remove(full_filepath_variant)
         
         self.is_deleted = True
     
@@ -175,90 +208,47 @@ class File(db.Model):
     def make_thumbnail(self):
         if not self.is_image:
             return False
-        if self.filename.endswith('.pdf'):
-            # PDF files are not supported for thumbnail generation
+        if not images.make_thumbnail(self.full_filepath, self.full_filepath_thumbnail, self.THUMBNAIL_SIZE):
             return False
-        im = self.open_image()
-        if not im:
-            return False
-        im = ImageOps.exif_transpose(im)
-        im.thumbnail(self.THUMBNAIL_SIZE)
-        im.save(os.path.join(self.full_filepath_thumbnail))
         self.has_thumbnail = True
         return True
     
     def rotate(self, rotation: Literal[0] | Literal[90] | Literal[180] | Literal[270] | None = None, make_thumbnail: bool=True):
+        '''Rotates a JPEG clockwise, losslessly, by changing its EXIF orientation'''
         if not self.is_image:
             return
         
         if self.filename.lower().split('.')[-1] not in ('jpg', 'jpeg'):
             return
         
-        command: list[str]
-        if rotation == 0:
-            command = ["exiftran", '-a', '-ni', '-i', self.full_filepath]
-        else:
-            option: list[str] = {
-                0: ['-a', '-no'],
-                90: ['-9'],
-                180: ['-1'],
-                270: ['-2'],
-                None: ['-a'],
-            }[rotation]
-
-            command = ["exiftran", *option, '-i', self.full_filepath]
-        result = subprocess.run(command, capture_output=True)
-        if result.returncode != 0:
-            raise RuntimeError("exiftran failed: " + repr(result))
+        if not rotation:
+            # The EXIF orientation is honoured everywhere, so the image is already displayed upright
+            if make_thumbnail and not self.has_thumbnail:
+                self.make_thumbnail()
+            return
+
+        jpeg.rotate(self.full_filepath, rotation)
         
         if self.original_md5 is None:
             self.original_md5 = self.md5
+        if self.original_sha256 is None:
+            self.original_sha256 = self.sha256
         
-        self.calculate_md5sum()
+        self.calculate_hashes()
 
         if make_thumbnail:
-            self.make_thumbnail()
+            if not (self.has_thumbnail and images.rotate_thumbnail(self.full_filepath_thumbnail, rotation)):
+                self.make_thumbnail()
     
     def read_barcodes(self, symbols=None):
-        if pyzbar is None:
-            print("Warning: pyzbar was not found, thus no barcode detection was done.")
-            return None
-
         if not self.is_image:
             return
-        im = self.open_image()
-        if not im:
-            return
-        try:
-            im = ImageEnhance.Color(im).enhance(0)
-            im = ImageEnhance.Contrast(im).enhance(2)
-            im = ImageEnhance.Sharpness(im).enhance(-1)
-        except ValueError:
-            return None
-        
-        im.thumbnail((1200, 1200))
-
-        if symbols:
-            return pyzbar.decode(im, symbols=symbols)
-        else:
-            return pyzbar.decode(im)
+        return images.read_barcodes(self.full_filepath, symbols=symbols)
     
     def read_rh_barcode(self):
         if not self.is_image:
             return
-        if not pyzbar:
-            return
-        
-        barcodes = self.read_barcodes(symbols=[pyzbar.ZBarSymbol.CODE128])
-        if not barcodes:
-            return
-        for barcode in barcodes:
-            if barcode.type == "CODE128" and barcode.data.decode('utf-8').startswith("RH") or barcode.data.decode('utf-8').startswith("HH"):
-                try:
-                    asset_id = int(barcode.data.decode('utf-8')[2:])
-                except Exception:
-                    continue
-                return asset_id
+        return images.read_rh_barcode(self.full_filepath)
 
     def auto_assign(self):
         if not self.is_image:
@@ -297,18 +287,24 @@ class File(db.Model):
         os.rename(os.path.join(files_dir, self.filepath), os.path.join(files_dir, new_filepath))
         if self.has_thumbnail:
             old_filepath_thumbnail = self.filepath_thumbnail
+            old_filepaths_thumbnail_variants = self.filepaths_thumbnail_variants
         else:
             old_filepath_thumbnail = None
+            old_filepaths_thumbnail_variants = []
         
         self.filepath = new_filepath
 
         if old_filepath_thumbnail:
             os.rename(os.path.join(files_dir, old_filepath_thumbnail), os.path.join(files_dir, self.filepath_thumbnail))
-
-    def calculate_md5sum(self):
-        # Let's launch a subprocess to (hopefully) be faster
-        result = subprocess.run(["md5sum", self.full_filepath], capture_output=True)
-        if result.returncode == 0:
-            hash = bytes.fromhex(result.stdout.split()[0].decode('ascii'))
-            self.md5 = hash
+        for old_variant, new_variant in zip(old_filepaths_thumbnail_variants, self.filepaths_thumbnail_variants):
+            if os.path.exists(os.path.join(files_dir, old_variant)):
+                os.rename(os.path.join(files_dir, old_variant), os.path.join(files_dir, new_variant))
+
+    def calculate_hashes(self):
+        '''Recalculates md5, sha256 and blake3 in a single pass over the file'''
+        with open(self.full_filepath, 'rb') as f:
+            hashes, _ = hash_file(f)
+        self.md5 = hashes.md5
+        self.sha256 = hashes.sha256
+        self.blake3 = hashes.blake3
         
\ No newline at end of file
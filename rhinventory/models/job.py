@@ -0,0 +1,51 @@
+import enum
+from datetime import datetime
+
+from sqlalchemy import Enum, ForeignKey, Index, Text
+from sqlalchemy.orm import Mapped, Relationship, mapped_column, relationship
+
+from rhinventory.extensions import db
+from rhinventory.models.file import File
+
+
+class JobType(enum.Enum):
+    thumbnail = "thumbnail"
+    auto_assign = "auto_assign"
+    size = "size"
+    hashes = "hashes"
+
+
+class JobStatus(enum.Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+PENDING_JOB_STATUSES = [JobStatus.queued, JobStatus.running]
+
+
+class Job(db.Model):
+    """A unit of background work on a file, processed by `python -m rhinventory.worker`."""
+    __tablename__ = 'jobs'
+    rhinventory_log = False
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    type: Mapped[JobType] = mapped_column(Enum(JobType), nullable=False)
+    status: Mapped[JobStatus] = mapped_column(Enum(JobStatus), nullable=False, default=JobStatus.queued)
+    file_id: Mapped[int] = mapped_column(ForeignKey('files.id'), nullable=False, index=True)
+    created_at: Mapped[datetime] = mapped_column(nullable=False, default=datetime.now)
+    started_at: Mapped[datetime | None] = mapped_column()
+    finished_at: Mapped[datetime | None] = mapped_column()
+    attempts: Mapped[int] = mapped_column(nullable=False, default=0)
+    error: Mapped[str | None] = mapped_column(Text)
+
+    file: Relationship[File] = relationship(File)
+
+    # the worker looks for queued jobs in order
+    __table_args__ = (
+        Index('ix_jobs_status_id', 'status', 'id'),
+    )
+
+    def __repr__(self) -> str:
+        return f'<Job {self.id} {self.type.value} file={self.file_id} {self.status.value}>'
@@ -1,12 +1,15 @@
 import json
 import datetime
 import enum
+import math
 import typing
 
 import flask_login
+from flask import current_app
+import msgspec
 from sqlalchemy import Boolean, Column, Integer, Numeric, String, Text, \
-    DateTime, ForeignKey, Enum, Index, inspect, event
-from sqlalchemy.orm import relationship, object_mapper, ColumnProperty
+    DateTime, ForeignKey, Enum, Index, inspect, event, insert
+from sqlalchemy.orm import InstanceState, Mapper, relationship
 
 from rhinventory.extensions import db
 from rhinventory.db import User
@@ -53,82 +56,164 @@ def log(event: LogEvent, object: typing.Any, log_object=True, user: User | None=
     db.session.add(log_item)
 
 
-def log_data(obj: typing.Any, event: str, data: dict[typing.Any, typing.Any]) -> None:
-    """Create LogItem object and save it to database, tailored for hook bellow.
-
-    :param obj: SQLAlchemy object from Session (data from current session)
-    :param event: str, that is converted to LogEvent column
-    :param data: dict with data, that are saved to object_json column
+def _log_json(data: dict[typing.Any, typing.Any]) -> str:
+    """
+    Same output as `json.dumps(data, default=repr, ensure_ascii=False)`, which the log
+    was written with before, only faster.
     """
+    values = {}
+    for key, value in data.items():
+        if isinstance(value, float) and not math.isfinite(value):
+            # JSON has no NaN or Infinity, json.dumps writes them anyway, msgspec doesn't
+            return json.dumps(data, default=repr, ensure_ascii=False)
+        if value is None or isinstance(value, (str, int, float, dict, list, tuple)):
+            # Including bools, and JSON columns whose contents are plain JSON
+            values[key] = value
+        else:
+            values[key] = repr(value)
+    return msgspec.json.format(msgspec.json.encode(values), indent=0).decode('utf-8')
+
+
+# Column attribute keys, by mapper
+_column_keys_cache: dict[Mapper, tuple[str, ...]] = {}
+
+def _column_keys(mapper: Mapper) -> tuple[str, ...]:
+    column_keys = _column_keys_cache.get(mapper)
+    if column_keys is None:
+        column_keys = _column_keys_cache[mapper] = tuple(prop.key for prop in mapper.column_attrs)
+    return column_keys
+
+
+def _is_logged(obj: typing.Any) -> bool:
+    if isinstance(obj, LogItem):
+        return False
 
     if isinstance(obj, DBEvent):
         # don't log events: they are read-only, additionally their ids are uuids and not integers,
         # which is incompatible with the current log table schema.
-        return
+        return False
 
     if getattr(obj, "rhinventory_log", True) is False:
         # object has logging disabled
-        return
+        return False
 
-    user_id = None
-    if flask_login.current_user and flask_login.current_user.is_authenticated:
-        user_id = flask_login.current_user.id
-    db.session.add(
-        LogItem(
-            table=type(obj).__name__,
-            object_id=obj.id,
-            event=event,
-            object_json=json.dumps(
-                data,
-                default=repr,
-                ensure_ascii=False),
-            object_json_new_format=True,
-            user_id=user_id,
-            datetime=datetime.datetime.now(),
-            extra_json="{}"
-        )
+    return True
+
+
+def log_data(obj: typing.Any, event: str, data: dict[typing.Any, typing.Any],
+             user_id: int | None, now: datetime.datetime) -> dict[str, typing.Any]:
+    """Values of a LogItem row, tailored for hook bellow.
+
+    :param obj: SQLAlchemy object from Session (data from current session)
+    :param event: str, that is converted to LogEvent column
+    :param data: dict with data, that are saved to object_json column
+    """
+    return dict(
+        table=type(obj).__name__,
+        object_id=obj.id,
+        event=LogEvent[event],
+        object_json=_log_json(data),
+        object_json_new_format=True,
+        user_id=user_id,
+        datetime=now,
+        extra_json="{}",
     )
 
 
+def _created_data(state: InstanceState) -> dict[str, typing.Any]:
+    dict_ = state.dict
+    data = {}
+    for key in _column_keys(state.mapper):
+        if key in dict_:
+            data[key] = dict_[key]
+        elif key in state.expired_attributes:
+            # e.g. server defaults, fetched after the insert
+            data[key] = state.attrs[key].value
+        else:
+            data[key] = None
+    return data
+
+
+def _updated_data(state: InstanceState) -> dict[str, typing.Any]:
+    # Only modified attributes have their committed value kept
+    modified = state.committed_state
+    changes = {}
+    for key in _column_keys(state.mapper):
+        if key in modified and state.attrs[key].history.has_changes():
+            changes[key] = state.dict.get(key)
+    return changes
+
+
+def _write_log_rows(session, rows: list[dict[str, typing.Any]]) -> None:
+    session.connection().execute(insert(LogItem.__table__), rows)
+
+
+# With AUDIT_LOG_DEFERRED, log rows of a transaction are collected here and written
+# in a single insert right before it commits, still inside it: the log is written
+# if and only if the transaction commits.
+_DEFERRED_LOG_ROWS_KEY = 'rhinventory_deferred_log_rows'
+_COMMITTING_KEY = 'rhinventory_log_committing'
+
+def _deferred_log_rows(session) -> list[dict[str, typing.Any]] | None:
+    """The buffer for log rows of the current transaction, or None if they are to be written right away."""
+    if not current_app.config.get('AUDIT_LOG_DEFERRED', False):
+        return None
+    # A savepoint can be rolled back on its own, its rows would have to be dropped with it
+    if session.in_nested_transaction() or session.info.get(_COMMITTING_KEY):
+        return None
+    return session.info.setdefault(_DEFERRED_LOG_ROWS_KEY, [])
+
+
+@event.listens_for(db.session, 'before_commit')
+def write_deferred_log_rows(session):
+    if not current_app.config.get('AUDIT_LOG_DEFERRED', False) or session.in_nested_transaction():
+        return
+    # Commit flushes only after this hook, so flush now to have the final changes logged too
+    session.flush()
+    rows = session.info.pop(_DEFERRED_LOG_ROWS_KEY, None)
+    # Anything flushed later during this commit is written right away
+    session.info[_COMMITTING_KEY] = True
+    if rows:
+        _write_log_rows(session, rows)
+
+
+@event.listens_for(db.session, 'after_transaction_end')
+def forget_deferred_log_rows(session, transaction):
+    if transaction.parent is None:
+        # Either written by now, or rolled back
+        session.info.pop(_DEFERRED_LOG_ROWS_KEY, None)
+        session.info.pop(_COMMITTING_KEY, None)
+
+
 @event.listens_for(db.session, 'after_flush')
 def receive_after_flush(session, flush_context):
     """The hook for saving changes in DB."""
-    for obj in session.new:
-        if isinstance(obj, LogItem):  # ignore LogItem objects
-            continue
-
-        data = {}
-        for mapper_property in object_mapper(obj).iterate_properties:
-            if isinstance(mapper_property, ColumnProperty):
-                key = mapper_property.key
-                attribute_state = inspect(obj).attrs.get(key)
-                data[key] = attribute_state.value
+    user_id = None
+    if flask_login.current_user and flask_login.current_user.is_authenticated:
+        user_id = flask_login.current_user.id
+    now = datetime.datetime.now()
 
-        log_data(obj, "Create", data)
+    rows = []
+    for obj in session.new:
+        if _is_logged(obj):
+            rows.append(log_data(obj, "Create", _created_data(inspect(obj)), user_id, now))
 
-    changed_objects = session.new.union(session.dirty)
-    for obj in changed_objects:
-        if isinstance(obj, LogItem):  # ignore LogItem objects
+    for obj in session.dirty:
+        if not _is_logged(obj):
             continue
-
-        changes = {}
-        if not inspect(obj).persistent:
+        state = inspect(obj)
+        if not state.persistent:
             continue
-
-        for mapper_property in object_mapper(obj).iterate_properties:
-            if isinstance(mapper_property, ColumnProperty):
-                key = mapper_property.key
-                attribute_state = inspect(obj).attrs.get(key)
-                history = attribute_state.history
-
-                if history.has_changes():
-                    value = attribute_state.value
-                    changes[key] = value
-
-        log_data(obj, "Update", changes)
+        rows.append(log_data(obj, "Update", _updated_data(state), user_id, now))
 
     for obj in session.deleted:
-        if isinstance(obj, LogItem):  # ignore LogItem objects
-            continue
+        if _is_logged(obj):
+            rows.append(log_data(obj, "Delete", {}, user_id, now))
 
-        log_data(obj, "Delete", {})
\ No newline at end of file
+    if not rows:
+        return
+    deferred_rows = _deferred_log_rows(session)
+    if deferred_rows is None:
+        _write_log_rows(session, rows)
+    else:
+        deferred_rows.extend(rows)
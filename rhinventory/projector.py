@@ -0,0 +1,77 @@
+"""
+Projector applying stored events to the aggregates, for `AGGREGATE_PROJECTION_ASYNC`.
+
+Run with `python -m rhinventory.projector`.  It catches up from the aggregate
+checkpoints, then waits for ingests to be notified (or polls, as a fallback).
+A single projector is enough; more of them wait on each other's locks.
+"""
+import argparse
+import select
+import time
+
+from rhinventory.app import create_app
+from rhinventory.event_store.event_store import EVENTS_NOTIFY_CHANNEL, event_store
+from rhinventory.extensions import db
+
+# How often to print the projection lag, in seconds
+LAG_REPORT_INTERVAL = 60
+
+
+def listen():
+    """A connection of its own, outside of the pool, listening to ingest notifications."""
+    pool_connection = db.engine.raw_connection()
+    pool_connection.detach()
+    connection = pool_connection.driver_connection
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute(f"LISTEN {EVENTS_NOTIFY_CHANNEL}")
+    return connection
+
+
+def wait_for_events(connection, timeout: float) -> None:
+    if connection is None:
+        time.sleep(timeout)
+        return
+    if select.select([connection], [], [], timeout) != ([], [], []):
+        connection.poll()
+        # Any number of notifications means the same: catch up
+        connection.notifies.clear()
+
+
+def print_lag() -> None:
+    for aggregate_table, lag in event_store.projection_lag().items():
+        print(f"{aggregate_table}: {lag['positions_behind']} positions, {lag['seconds_behind']:.1f} s behind")
+    db.session.rollback()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Apply stored events to the aggregates.")
+    parser.add_argument('--poll-interval', type=float, default=10.0,
+                        help="seconds to wait for a notification before checking for new events anyway")
+    parser.add_argument('--no-listen', action='store_true',
+                        help="only poll, e.g. behind a connection pooler that doesn't support LISTEN")
+    parser.add_argument('--once', action='store_true',
+                        help="exit once the aggregates have caught up")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        connection = None if args.no_listen else listen()
+
+        print("Projecting events...")
+        last_lag_report = 0.0
+        while True:
+            if time.monotonic() - last_lag_report > LAG_REPORT_INTERVAL:
+                print_lag()
+                last_lag_report = time.monotonic()
+
+            applied = event_store.catch_up()
+            if applied:
+                print(f"Applied {applied} events")
+            if args.once:
+                break
+            wait_for_events(connection, args.poll_interval)
+
+
+if __name__ == '__main__':
+    main()
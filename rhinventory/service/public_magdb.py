@@ -168,7 +168,7 @@ class PublicMagDBService:
                 real_filepath = url_for('file', file_id=file_id, filename=filepath.split('/')[-1])
 
                 if has_thumbnail:
-                    thumbnail_path = url_for('file', file_id=file_id, filename=filepath.split('/')[-1], thumb=True)
+                    thumbnail_path = url_for('file', file_id=file_id, filename=filepath.split('/')[-1], thumb=True, size=400)
                 else:
                     thumbnail_path = None
                 
@@ -0,0 +1,41 @@
+"""
+Background worker processing the file job queue.
+
+Run with `python -m rhinventory.worker`.  Several workers may run side by side.
+"""
+import argparse
+import time
+
+from rhinventory.app import create_app
+from rhinventory.jobs import claim_next_job, requeue_stale_jobs, run_job
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Process queued rhinventory jobs.")
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help="seconds to wait before checking an empty queue again")
+    parser.add_argument('--once', action='store_true',
+                        help="exit once the queue is empty")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        requeued = requeue_stale_jobs()
+        if requeued:
+            print(f"Requeued {requeued} stale jobs")
+
+        print("Waiting for jobs...")
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if args.once:
+                    break
+                time.sleep(args.poll_interval)
+                continue
+
+            print(f"Running {job}")
+            run_job(job)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+import argparse
+from datetime import datetime, timedelta
+
+from rhinventory.app import create_app
+from rhinventory.event_store.event_store import EventStore
+
+parser = argparse.ArgumentParser(description="Move old events from the database to EVENT_ARCHIVE_DIR.")
+parser.add_argument('--older-than-days', type=int, default=365,
+                    help="archive events ingested more than this many days ago")
+args = parser.parse_args()
+
+app = create_app()
+with app.app_context():
+    print("Archiving events...")
+    event_store = EventStore()
+    archived = event_store.archive_events(datetime.now() - timedelta(days=args.older_than_days), show_progress=True)
+    print(f"Done, {archived} events archived.")
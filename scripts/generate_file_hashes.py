@@ -9,6 +9,6 @@ app = create_app()
 with app.app_context():
     files = db.session.query(File).filter(File.md5 == None).all()
     for file in tqdm.tqdm(files):
-        file.calculate_md5sum()
+        file.calculate_hashes()
 
     db.session.commit()
\ No newline at end of file
@@ -1,8 +1,30 @@
+import argparse
+
 from rhinventory.app import create_app
+from rhinventory.models.aggregates.aggregate import registered_aggregate_classes
 from rhinventory.event_store.event_store import EventStore
+
+parser = argparse.ArgumentParser(description="Rebuild aggregates from the stored events.")
+parser.add_argument('--catch-up', action='store_true',
+                    help="only apply the events stored after each aggregate's checkpoint")
+parser.add_argument('aggregates', nargs='*', metavar='AGGREGATE',
+                    help="aggregate class names, all aggregates by default")
+args = parser.parse_args()
+
+aggregate_classes_by_name = {cls.__name__: cls for cls in registered_aggregate_classes}
+unknown = [name for name in args.aggregates if name not in aggregate_classes_by_name]
+if unknown:
+    parser.error(f"unknown aggregates: {', '.join(unknown)} (known: {', '.join(aggregate_classes_by_name)})")
+aggregate_classes = [aggregate_classes_by_name[name] for name in args.aggregates] or None
+
 app = create_app()
 with app.app_context():
-    print("Rebuilding aggregates...")
     event_store = EventStore()
-    event_store.rebuild_aggregates(show_progress=True)
-    print("Done.")
+    if args.catch_up:
+        print("Catching up aggregates...")
+        applied = event_store.catch_up(aggregate_classes, show_progress=True)
+        print(f"Done, {applied} events applied.")
+    else:
+        print("Rebuilding aggregates...")
+        event_store.rebuild_aggregates(aggregate_classes, show_progress=True)
+        print("Done.")
@@ -1,13 +1,23 @@
+from datetime import datetime, timedelta
 import uuid
 
 from flask_admin.tests.fileadmin import Flask
+import msgspec
 import pytest
 import sqlalchemy.exc
 
+from rhinventory.event_store.archive import ArchivedEvent, iter_archived_events, read_segment, segments, write_segment
 from rhinventory.event_store.event_store import EventSession, UnsupportedEventVersion, event_store
+from rhinventory.models.aggregates.floppy_disk_capture import AssetIdSource, FloppyDiskCapture
+from rhinventory.models.aggregates.statement import Statement
 from rhinventory.models.aggregates.test import TestAggregate
 from rhinventory.events.event import TestingEvent
+from rhinventory.events.floppy_disk_captures import FloppyDiskCaptureDisassociated, FloppyDiskCaptureReassigned
+from rhinventory.events.statements import StatementCreated, StatementDeleted
 from rhinventory.extensions import db
+from rhinventory.models.asset import Asset, AssetCategory
+from rhinventory.models.events import AggregateCheckpoint, DBEvent
+from rhinventory.models.properties.properties import properties
 
 def test_event_creation(app: Flask) -> None:
     with app.app_context():
@@ -43,3 +53,253 @@ def test_event_creation(app: Flask) -> None:
         assert aggregate_instance_after_rebuild is not None
         assert aggregate_instance_after_rebuild.latest_test_event_data == test_data
         
+
+def test_ingest_batch_is_all_or_nothing(app: Flask) -> None:
+    with app.app_context():
+        test_event_session = EventSession()
+        test_event_session.application_name = "test_events.py"
+        test_event_session.namespace = "rhinventory"
+        test_event_session.internal = True
+        db.session.add(test_event_session)
+        db.session.commit()
+
+        events = [TestingEvent(test_data=f"Batch event {i}") for i in range(3)]
+        event_store.ingest_batch(events=events, event_session=test_event_session)
+
+        aggregate_instance = db.session.query(TestAggregate).one_or_none()
+        assert aggregate_instance is not None
+        assert aggregate_instance.latest_test_event_data == "Batch event 2"
+
+        # The already stored event fails the whole batch
+        new_event = TestingEvent(test_data="Not stored")
+        with pytest.raises(sqlalchemy.exc.IntegrityError):
+            event_store.ingest_batch(events=[new_event, events[0]], event_session=test_event_session)
+
+        assert db.session.query(DBEvent).filter(DBEvent.id == new_event.event_id).count() == 0
+        aggregate_instance = db.session.query(TestAggregate).one()
+        assert aggregate_instance.latest_test_event_data == "Batch event 2"
+
+
+def test_ingest_batch_creating_and_deleting_a_statement(app: Flask) -> None:
+    with app.app_context():
+        test_event_session = EventSession()
+        test_event_session.application_name = "test_events.py"
+        test_event_session.namespace = "rhinventory"
+        test_event_session.internal = True
+        db.session.add(test_event_session)
+        db.session.commit()
+
+        # The statement doesn't exist in the database until the batch is flushed
+        created = StatementCreated(subject_id=1, property_id=properties[0].id, value="Short lived")
+        deleted = StatementDeleted(statement_id=created.event_id)
+        event_store.ingest_batch(events=[created, deleted], event_session=test_event_session)
+
+        statement = db.session.query(Statement).one()
+        assert statement.id == created.event_id
+        assert statement.value == "Short lived"
+        assert statement.deleted_at == deleted.event_timestamp
+
+        # Aggregates pending in the batch are forgotten with its transaction
+        later = StatementCreated(subject_id=1, property_id=properties[0].id, value="Later")
+        event_store.ingest_batch(events=[later, StatementDeleted(statement_id=created.event_id)],
+                                 event_session=test_event_session)
+        assert db.session.query(Statement).count() == 2
+        later_statement = db.session.get(Statement, later.event_id)
+        assert later_statement is not None
+        assert later_statement.deleted_at is None
+
+
+def test_rebuild_matches_incremental_ingest(app: Flask) -> None:
+    with app.app_context():
+        test_event_session = EventSession()
+        test_event_session.application_name = "test_events.py"
+        test_event_session.namespace = "rhinventory"
+        test_event_session.internal = True
+        db.session.add(test_event_session)
+        asset = Asset(organization_id=1, category=AssetCategory.game, name="Floppy Asset")
+        db.session.add(asset)
+        db.session.commit()
+        asset_id = asset.id
+
+        capture_ids = [uuid.uuid4(), uuid.uuid4()]
+        first_statement = StatementCreated(subject_id=asset_id, property_id=properties[0].id, value="First")
+        event_store.ingest(event=FloppyDiskCaptureReassigned(floppy_disk_capture_id=capture_ids[0], new_asset_id=asset_id),
+                           event_session=test_event_session)
+        event_store.ingest(event=first_statement, event_session=test_event_session)
+        event_store.ingest_batch(events=[
+            FloppyDiskCaptureDisassociated(floppy_disk_capture_id=capture_ids[0]),
+            FloppyDiskCaptureReassigned(floppy_disk_capture_id=capture_ids[1], new_asset_id=asset_id),
+            StatementCreated(subject_id=asset_id, property_id=properties[1].id, value="Second"),
+            StatementDeleted(statement_id=first_statement.event_id),
+        ], event_session=test_event_session)
+
+        aggregate_classes = [FloppyDiskCapture, Statement]
+
+        def rows() -> dict[type, list]:
+            return {aggregate_class: db.session.execute(
+                        sqlalchemy.select(aggregate_class.__table__).order_by(aggregate_class.__table__.c.id)
+                    ).all()
+                    for aggregate_class in aggregate_classes}
+
+        ingested_rows = rows()
+        assert len(ingested_rows[FloppyDiskCapture]) == 2
+        assert len(ingested_rows[Statement]) == 2
+
+        event_store.rebuild_aggregates(aggregate_classes=aggregate_classes)
+        db.session.expire_all()
+        assert rows() == ingested_rows
+
+        capture = db.session.get(FloppyDiskCapture, capture_ids[1])
+        assert capture is not None
+        assert capture.asset_id_source == AssetIdSource.REASSIGNMENT
+        assert capture.asset is not None
+        assert capture.asset.id == asset_id
+        disassociated_capture = db.session.get(FloppyDiskCapture, capture_ids[0])
+        assert disassociated_capture is not None
+        assert disassociated_capture.disassociated
+        assert disassociated_capture.asset is None
+
+
+def test_catch_up_applies_events_missed_by_aggregates_behind(app: Flask) -> None:
+    with app.app_context():
+        test_event_session = EventSession()
+        test_event_session.application_name = "test_events.py"
+        test_event_session.namespace = "rhinventory"
+        test_event_session.internal = True
+        db.session.add(test_event_session)
+        db.session.commit()
+
+        event_store.ingest(event=TestingEvent(test_data="First"), event_session=test_event_session)
+
+        # As if TestAggregate had been added after the first event was stored
+        checkpoint = db.session.get(AggregateCheckpoint, TestAggregate.__tablename__)
+        assert checkpoint is not None
+        checkpoint.position = 0
+        db.session.query(TestAggregate).delete()
+        db.session.commit()
+
+        # Aggregates that are behind are skipped on ingest...
+        event_store.ingest(event=TestingEvent(test_data="Second"), event_session=test_event_session)
+        assert db.session.query(TestAggregate).one_or_none() is None
+
+        # ...until they catch up
+        assert event_store.catch_up(aggregate_classes=[TestAggregate]) == 2
+        aggregate_instance = db.session.query(TestAggregate).one()
+        assert aggregate_instance.latest_test_event_data == "Second"
+        checkpoint = db.session.get(AggregateCheckpoint, TestAggregate.__tablename__)
+        assert checkpoint is not None
+        assert checkpoint.position == db.session.query(db.func.max(DBEvent.position)).scalar()
+
+
+def test_catch_up_from_a_moved_back_checkpoint(app: Flask) -> None:
+    with app.app_context():
+        test_event_session = EventSession()
+        test_event_session.application_name = "test_events.py"
+        test_event_session.namespace = "rhinventory"
+        test_event_session.internal = True
+        db.session.add(test_event_session)
+        db.session.commit()
+
+        created = [StatementCreated(subject_id=1, property_id=properties[0].id, value=f"Value {i}") for i in range(3)]
+        # Stored as pushed, catching up decodes the stored JSON again
+        event_store.ingest_batch(events=created, event_session=test_event_session,
+                                 serialized_events=[msgspec.json.encode(event) for event in created])
+        deleted = StatementDeleted(statement_id=created[0].event_id)
+        event_store.ingest(event=deleted, event_session=test_event_session)
+
+        first_position = db.session.query(DBEvent.position).filter(DBEvent.id == created[0].event_id).scalar()
+        last_position = db.session.query(db.func.max(DBEvent.position)).scalar()
+        checkpoint = db.session.get(AggregateCheckpoint, Statement.__tablename__)
+        assert checkpoint is not None
+        assert checkpoint.position == last_position
+
+        # Events after the checkpoint are applied again, to the statements that already exist
+        checkpoint.position = first_position
+        db.session.commit()
+        assert event_store.catch_up(aggregate_classes=[Statement]) == 3
+
+        statements = {statement.id: statement for statement in db.session.query(Statement)}
+        assert set(statements) == {event.event_id for event in created}
+        assert statements[created[0].event_id].deleted_at == deleted.event_timestamp
+        assert [statements[event.event_id].value for event in created] == ["Value 0", "Value 1", "Value 2"]
+        assert all(statements[event.event_id].deleted_at is None for event in created[1:])
+        checkpoint = db.session.get(AggregateCheckpoint, Statement.__tablename__)
+        assert checkpoint is not None
+        assert checkpoint.position == last_position
+
+
+def test_async_projection(app: Flask) -> None:
+    with app.app_context():
+        app.config['AGGREGATE_PROJECTION_ASYNC'] = True
+        test_event_session = EventSession()
+        test_event_session.application_name = "test_events.py"
+        test_event_session.namespace = "rhinventory"
+        test_event_session.internal = True
+        db.session.add(test_event_session)
+        db.session.commit()
+
+        event_store.ingest(event=TestingEvent(test_data="Projected later"), event_session=test_event_session)
+        assert db.session.query(TestAggregate).one_or_none() is None
+        assert event_store.projection_lag()[TestAggregate.__tablename__]['positions_behind'] == 1
+
+        # What the projector does
+        assert event_store.catch_up() == 1
+        aggregate_instance = db.session.query(TestAggregate).one()
+        assert aggregate_instance.latest_test_event_data == "Projected later"
+        assert event_store.projection_lag()[TestAggregate.__tablename__]['positions_behind'] == 0
+
+
+def test_archived_events_are_replayed(app: Flask, tmp_path) -> None:
+    with app.app_context():
+        app.config['EVENT_ARCHIVE_DIR'] = str(tmp_path)
+        test_event_session = EventSession()
+        test_event_session.application_name = "test_events.py"
+        test_event_session.namespace = "rhinventory"
+        test_event_session.internal = True
+        db.session.add(test_event_session)
+        db.session.commit()
+
+        for i in range(3):
+            event_store.ingest(event=TestingEvent(test_data=f"Event {i}"), event_session=test_event_session)
+
+        # The newest event always stays in the table
+        assert event_store.archive_events(older_than=datetime.now() + timedelta(days=1)) == 2
+        assert db.session.query(DBEvent).count() == 1
+
+        event_store.rebuild_aggregates(aggregate_classes=[TestAggregate])
+        assert db.session.query(TestAggregate).one().latest_test_event_data == "Event 2"
+
+        checkpoint = db.session.get(AggregateCheckpoint, TestAggregate.__tablename__)
+        assert checkpoint is not None
+        checkpoint.position = 0
+        db.session.commit()
+        assert event_store.catch_up(aggregate_classes=[TestAggregate]) == 3
+
+
+def test_archive_segment_round_trip(tmp_path) -> None:
+    now = datetime.now()
+    events = [
+        ArchivedEvent(
+            id=uuid.uuid7(), position=position, namespace="rhinventory", class_name=type(event).__name__,
+            timestamp=event.event_timestamp, ingested_at=now, event_session_id=1,
+            related_asset_id=getattr(event, 'subject_id', None), data=msgspec.json.encode(event),
+        )
+        for position, event in enumerate([
+            TestingEvent(test_data="First"),
+            StatementCreated(subject_id=42, property_id=properties[0].id, value="Archived"),
+            TestingEvent(test_data="Third"),
+            TestingEvent(test_data="Fourth"),
+            StatementCreated(subject_id=43, property_id=properties[0].id, value="Last"),
+        ], start=1)
+    ]
+
+    first_path = write_segment(str(tmp_path), events[:3])
+    second_path = write_segment(str(tmp_path), events[3:])
+    assert segments(str(tmp_path)) == [(1, 3, first_path), (4, 5, second_path)]
+    assert read_segment(first_path) + read_segment(second_path) == events
+    assert read_segment(first_path)[1].related_asset_id == 42
+
+    # Filtered by class and limited to the positions between the checkpoint and the table
+    replayed = list(iter_archived_events(str(tmp_path), ["TestingEvent"], after_position=1, before_position=5))
+    assert [event.position for event in replayed] == [3, 4]
+    assert [msgspec.json.decode(event.data)['test_data'] for event in replayed] == ["Third", "Fourth"]
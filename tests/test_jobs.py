@@ -0,0 +1,67 @@
+from flask.testing import FlaskClient
+
+from rhinventory.jobs import MAX_ATTEMPTS, claim_next_job, enqueue, run_job
+from rhinventory.models.file import File, FileCategory, FileStore, Privacy
+from rhinventory.models.job import Job, JobStatus, JobType
+
+
+def test_upload_enqueues_jobs_for_the_worker(app, client: FlaskClient, db_session):
+    app.config['BACKGROUND_JOBS_ENABLED'] = True
+
+    data = {
+        'category': FileCategory.image.value,
+        'privacy': Privacy.private_implicit.value,
+        'batch_number': 1,
+        'sort_by_filename': '',
+        'xhr': '1',
+        'files': [(open('tests/data/test_image.png', 'rb'), 'test_image.png')],
+    }
+    response = client.post("/file/upload/", data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    file_id, = response.json['files']
+
+    # Thumbnailing is left to the worker
+    file = db_session.get(File, file_id)
+    assert file is not None
+    assert not file.has_thumbnail
+    jobs = db_session.query(Job).filter(Job.file_id == file_id).all()
+    assert JobType.thumbnail in {job.type for job in jobs}
+    assert all(job.status == JobStatus.queued for job in jobs)
+
+    # What the worker does
+    while (job := claim_next_job()) is not None:
+        run_job(job)
+
+    jobs = db_session.query(Job).filter(Job.file_id == file_id).all()
+    assert all(job.status == JobStatus.done for job in jobs)
+    file = db_session.get(File, file_id)
+    assert file is not None
+    assert file.has_thumbnail
+
+
+def test_failing_job_is_retried_then_failed(db_session):
+    file = File(
+        filepath="does_not_exist.bin",
+        storage=FileStore.local,
+        category=FileCategory.dump,
+    )
+    db_session.add(file)
+    db_session.commit()
+    job = enqueue(file, JobType.size)
+    db_session.commit()
+    job_id = job.id
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        claimed_job = claim_next_job()
+        assert claimed_job is not None
+        assert claimed_job.id == job_id
+        run_job(claimed_job)
+
+        job = db_session.get(Job, job_id)
+        assert job is not None
+        assert job.attempts == attempt
+        assert job.error is not None
+        expected_status = JobStatus.failed if attempt == MAX_ATTEMPTS else JobStatus.queued
+        assert job.status == expected_status
+
+    assert claim_next_job() is None
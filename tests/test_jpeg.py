@@ -0,0 +1,73 @@
+"""
+Tests for lossless JPEG rotation, which rewrites original files in place.
+"""
+from PIL import Image
+
+from rhinventory.files import jpeg
+
+
+def _make_jpeg(path, orientation: int | None = None) -> None:
+    im = Image.new('RGB', (64, 32), (200, 50, 50))
+    im.paste((20, 20, 220), (0, 0, 16, 32))
+    if orientation is None:
+        # Pillow writes a JFIF APP0 segment and no EXIF
+        im.save(path, format='JPEG')
+    else:
+        exif = Image.Exif()
+        exif[jpeg.ORIENTATION_TAG] = orientation
+        im.save(path, format='JPEG', exif=exif.tobytes())
+
+
+def _image_data(path) -> bytes:
+    """Everything from the SOS marker on: the compressed image itself."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return data[data.index(b'\xff\xda'):]
+
+
+def test_set_orientation_patches_existing_tag(tmp_path):
+    path = tmp_path / "exif.jpg"
+    _make_jpeg(path, orientation=1)
+    image_data = _image_data(path)
+    size = path.stat().st_size
+
+    jpeg.set_orientation(str(path), 6)
+
+    assert jpeg.get_orientation(str(path)) == 6
+    # Patched in place, nothing else moved
+    assert path.stat().st_size == size
+    assert _image_data(path) == image_data
+
+
+def test_rotate_adds_exif_to_jfif(tmp_path):
+    path = tmp_path / "jfif.jpg"
+    _make_jpeg(path)
+    image_data = _image_data(path)
+    with Image.open(path) as im:
+        assert jpeg.ORIENTATION_TAG not in im.getexif()
+
+    jpeg.rotate(str(path), 90)
+
+    assert jpeg.get_orientation(str(path)) == 6
+    assert _image_data(path) == image_data
+    with open(path, 'rb') as f:
+        data = f.read()
+    # JFIF requires its APP0 segment right after SOI
+    assert data[2:4] == b'\xff\xe0'
+    with Image.open(path) as im:
+        im.load()
+        assert im.size == (64, 32)
+
+
+def test_rotate_full_circle(tmp_path):
+    path = tmp_path / "circle.jpg"
+    _make_jpeg(path, orientation=1)
+    image_data = _image_data(path)
+
+    orientations = []
+    for _ in range(4):
+        jpeg.rotate(str(path), 90)
+        orientations.append(jpeg.get_orientation(str(path)))
+
+    assert orientations == [6, 3, 8, 1]
+    assert _image_data(path) == image_data
@@ -5,13 +5,19 @@ These tests use PostgreSQL running in a podman container.
 The conftest.py file manages the container lifecycle and database setup.
 """
 import io
+import json
 import os
 import zipfile
 
 from flask.testing import FlaskClient
+from PIL import Image
 
+from rhinventory.files.delivery import PRIVATE_MAX_AGE, SHARED_MAX_AGE
+from rhinventory.files.images import supported_thumbnail_variant_formats
+from rhinventory.files.thumbnail_cache import ThumbnailCache
 from rhinventory.models.asset import Asset, AssetCategory
 from rhinventory.models.file import File, FileCategory, FileStore, Privacy
+from rhinventory.models.log import LogEvent, LogItem
 
 
 def test_index(client: FlaskClient):
@@ -86,6 +92,37 @@ def test_file_upload(client: FlaskClient):
     assert response.status_code in (200, 302)
 
 
+def test_file_upload_duplicates(client: FlaskClient, db_session):
+    data = {
+        'category': FileCategory.image.value,
+        'privacy': Privacy.private_implicit.value,
+        'batch_number': 1,
+        'sort_by_filename': '',
+        'xhr': '1',
+    }
+
+    # The same image twice in one batch, only one copy should be stored
+    data['files'] = [
+        (open('tests/data/test_image.png', 'rb'), 'test_image.png'),
+        (open('tests/data/test_image.png', 'rb'), 'test_image_copy.png'),
+    ]
+    response = client.post("/file/upload/", data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert len(response.json['files']) == 1
+    assert len(response.json['duplicate_files']) == 1
+
+    # Uploading it again in a later batch is detected against the database
+    data['files'] = [(open('tests/data/test_image.png', 'rb'), 'test_image.png')]
+    response = client.post("/file/upload/", data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert response.json['files'] == []
+    assert len(response.json['duplicate_files']) == 1
+
+    assert db_session.query(File).count() == 1
+    # Uploads are streamed into the store, the discarded duplicates are not left behind
+    assert [name for name in os.listdir("files/uploads") if name.endswith(".part")] == []
+
+
 def test_asset_download_files(client: FlaskClient, db_session):
     asset = Asset(organization_id=1, category=AssetCategory.game, name="Zip Test Asset")
     db_session.add(asset)
@@ -115,3 +152,155 @@ def test_asset_download_files(client: FlaskClient, db_session):
     with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
         assert zf.namelist() == [f"hh{asset_id}/{filepath}"]
         assert zf.read(f"hh{asset_id}/{filepath}") == contents
+
+
+def test_file_conditional_get(client: FlaskClient, db_session):
+    files_dir = "files"
+    os.makedirs(files_dir, exist_ok=True)
+    filepath = "test_conditional_get.bin"
+    contents = bytes(range(256)) * 100
+    with open(os.path.join(files_dir, filepath), 'wb') as f:
+        f.write(contents)
+
+    file = File(
+        filepath=filepath,
+        storage=FileStore.local,
+        category=FileCategory.dump,
+        privacy=Privacy.public,
+        blake3=bytes(range(32)),
+    )
+    db_session.add(file)
+    db_session.commit()
+    version = file.content_version
+
+    response = client.get(f"/files/{file.id}?v={version}")
+    assert response.status_code == 200
+    assert response.data == contents
+    assert response.headers['ETag'] == f'"{version}"'
+    assert response.cache_control.immutable
+    assert response.cache_control.public
+    assert response.cache_control.s_maxage == SHARED_MAX_AGE
+
+    response = client.get(f"/files/{file.id}", headers={'If-None-Match': f'"{version}"'})
+    assert response.status_code == 304
+
+    response = client.get(f"/files/{file.id}", headers={'Range': 'bytes=256-511'})
+    assert response.status_code == 206
+    assert response.data == contents[256:512]
+
+    # Hidden files are kept out of shared caches and not cached for good, even under a versioned URL
+    file.privacy = Privacy.private
+    db_session.commit()
+    response = client.get(f"/files/{file.id}?v={version}")
+    assert response.status_code == 200
+    assert response.cache_control.private
+    assert not response.cache_control.public
+    assert not response.cache_control.immutable
+    assert response.cache_control.max_age == PRIVATE_MAX_AGE
+
+
+def test_thumbnail_variants(client: FlaskClient, db_session):
+    files_dir = "files"
+    os.makedirs(files_dir, exist_ok=True)
+    filepath = "test_thumbnail_variants.png"
+    Image.new('RGB', (1000, 500), (10, 120, 200)).save(os.path.join(files_dir, filepath))
+
+    file = File(
+        filepath=filepath,
+        storage=FileStore.local,
+        category=FileCategory.image,
+        privacy=Privacy.public,
+        blake3=bytes(range(1, 33)),
+    )
+    db_session.add(file)
+    db_session.commit()
+
+    # Requested sizes are rounded up to the next standard size
+    for requested_size, size in ((100, 160), (160, 160), (161, 400), (800, 800), (5000, 800)):
+        response = client.get(f"/files/{file.id}/thumb?size={requested_size}", headers={'Accept': '*/*'})
+        assert response.status_code == 200
+        assert 'Accept' in response.vary
+        with Image.open(io.BytesIO(response.data)) as im:
+            assert max(im.size) == size
+
+    supported_formats = supported_thumbnail_variant_formats()
+    for accept, format in (
+            ('image/avif', 'avif' if 'avif' in supported_formats else 'jpeg'),
+            ('image/webp', 'webp' if 'webp' in supported_formats else 'jpeg'),
+            ('*/*', 'jpeg')):
+        response = client.get(f"/files/{file.id}/thumb?size=160", headers={'Accept': accept})
+        assert response.status_code == 200
+        assert response.mimetype == f"image/{format}"
+        assert 'Accept' in response.vary
+        with Image.open(io.BytesIO(response.data)) as im:
+            assert im.format == format.upper()
+
+
+def test_thumbnail_cache(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), max_size=1000)
+    created = []
+
+    def create(path):
+        created.append(path)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 400)
+
+    # Miss
+    path = cache.get_or_create("1-a-160.webp", create)
+    assert len(created) == 1
+    assert os.path.getsize(path) == 400
+
+    # Hit
+    assert cache.get_or_create("1-a-160.webp", create) == path
+    assert len(created) == 1
+
+    # Past the size limit the least recently used entry goes, along with its lock
+    os.utime(path, (0, 0))
+    cache.get_or_create("2-b-160.webp", create)
+    cache.get_or_create("3-c-160.webp", create)
+    assert len(created) == 3
+    assert not os.path.exists(path)
+    assert not os.path.exists(tmp_path / ".locks" / "1-a-160.webp.lock")
+    assert os.path.exists(tmp_path / "2-b-160.webp")
+    assert os.path.exists(tmp_path / "3-c-160.webp")
+    assert os.path.exists(tmp_path / ".locks" / "3-c-160.webp.lock")
+
+
+def test_changes_are_logged(db_session):
+    asset = Asset(organization_id=1, category=AssetCategory.game, name="Logged Asset")
+    db_session.add(asset)
+    db_session.commit()
+
+    asset_id = asset.id
+    asset.name = "Renamed Asset"
+    db_session.commit()
+
+    db_session.delete(asset)
+    db_session.commit()
+
+    log_items = db_session.query(LogItem).filter(
+        LogItem.table == "Asset",
+        LogItem.object_id == asset_id,
+    ).order_by(LogItem.id).all()
+    assert [log_item.event for log_item in log_items] == [LogEvent.Create, LogEvent.Update, LogEvent.Delete]
+    assert json.loads(log_items[0].object_json)["name"] == "Logged Asset"
+    assert json.loads(log_items[1].object_json) == {"name": "Renamed Asset"}
+
+
+def test_deferred_log_is_written_on_commit_only(app, db_session):
+    app.config['AUDIT_LOG_DEFERRED'] = True
+
+    rolled_back = Asset(organization_id=1, category=AssetCategory.game, name="Rolled Back Asset")
+    db_session.add(rolled_back)
+    db_session.flush()
+    db_session.rollback()
+    assert db_session.query(LogItem).filter(LogItem.table == "Asset").count() == 0
+
+    asset = Asset(organization_id=1, category=AssetCategory.game, name="Committed Asset")
+    db_session.add(asset)
+    db_session.flush()
+    asset.name = "Renamed Committed Asset"
+    db_session.commit()
+
+    log_items = db_session.query(LogItem).filter(LogItem.table == "Asset").order_by(LogItem.id).all()
+    assert [log_item.event for log_item in log_items] == [LogEvent.Create, LogEvent.Update]